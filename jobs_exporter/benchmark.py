@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+"""benchmark.py: Offline benchmarks for jobs_exporter, on fake /proc trees so they can run without a Slurm node"""
+
+import os
+import re
+import time
+import shutil
+import tempfile
+import argparse
+import resource
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import jobs_exporter
+
+# Fake processes get pids starting at this number so they can't be confused with real ones
+FIRST_PID = 100000
+
+
+def write_file(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def make_fake_process(root, pid, name, tids, fds, uptime):
+    """
+    Writes the /proc/<pid> directory of a fake process. Its threads only get a /proc/<pid>/task/<tid>/stat file,
+    like in a real procfs where threads don't appear in the listing of /proc.
+
+    Parameters
+    ----------
+    root : string
+        path of the fake procfs
+    pid : integer
+        id of the process
+    name : string
+        name of the process
+    tids : list
+        ids of the threads of the process, including the main thread (pid)
+    fds : list
+        paths the file descriptors of the process link to
+    uptime : integer
+        fake uptime of the system in seconds, the process starts 10 seconds before
+    """
+    proc_dir = os.path.join(root, str(pid))
+    os.makedirs(os.path.join(proc_dir, "fd"))
+    os.makedirs(os.path.join(proc_dir, "task"))
+    starttime = (uptime - 10) * jobs_exporter.CLK_TCK
+    # 52 fields like a real stat file, see proc(5)
+    fields = ["S", str(pid - 1), str(pid), str(pid), "0", "-1", "4194304",
+              "100", "0", "0", "0", str(pid % 1000), str(pid % 100), "0", "0",
+              "20", "0", str(len(tids)), "0", str(starttime), "1000000",
+              "250", "18446744073709551615"] + ["0"] * 29
+    stat = "%d (%s) %s\n" % (pid, name, " ".join(fields))
+    write_file(os.path.join(proc_dir, "stat"), stat)
+    for tid in tids:
+        os.makedirs(os.path.join(proc_dir, "task", str(tid)))
+        write_file(os.path.join(proc_dir, "task", str(tid), "stat"), stat)
+    write_file(
+        os.path.join(proc_dir, "status"),
+        "Name:\t%s\nUmask:\t0022\nState:\tS (sleeping)\nTgid:\t%d\nNgid:\t0\nPid:\t%d\nPPid:\t%d\nTracerPid:\t0\n"
+        "Uid:\t1000\t1000\t1000\t1000\nGid:\t1000\t1000\t1000\t1000\nFDSize:\t64\nVmRSS:\t1000 kB\n"
+        "Threads:\t%d\nvoluntary_ctxt_switches:\t10\nnonvoluntary_ctxt_switches:\t1\n"
+        % (name, pid, pid, pid - 1, len(tids)),
+    )
+    write_file(
+        os.path.join(proc_dir, "io"),
+        "rchar: 4096\nwchar: 2048\nsyscr: 10\nsyscw: 5\nread_bytes: 1048576\nwrite_bytes: 524288\ncancelled_write_bytes: 0\n",
+    )
+    write_file(os.path.join(proc_dir, "statm"), "25000 250 100 10 0 2000 0\n")
+    write_file(os.path.join(proc_dir, "cmdline"), "/usr/bin/%s\0--input\0data\0" % name)
+    write_file(os.path.join(proc_dir, "environ"),
+               "HOME=/home/user\0SLURM_JOB_ID=1\0SLURM_JOB_GPUS=0,1\0")
+    for fd, path in enumerate(fds):
+        os.symlink(path, os.path.join(proc_dir, "fd", str(fd)))
+
+
+def make_fake_procfs(root, num_pids, threads_per_pid=1, fds_per_pid=4):
+    """
+    Generates a fake procfs with num_pids processes
+
+    Parameters
+    ----------
+    root : string
+        path in which to create the fake procfs
+    num_pids : integer
+        number of processes to create
+    threads_per_pid : integer
+        number of threads per process (including the main thread)
+    fds_per_pid : integer
+        number of file descriptors per process
+
+    Returns
+    -------
+    list
+        every pid and tid in the fake procfs, in the order a cgroup tasks file would list them
+    """
+    uptime = 1000000
+    write_file(os.path.join(root, "uptime"), "%d.00 0.00\n" % uptime)
+    write_file(os.path.join(root, "stat"), "cpu  0 0 0 0 0 0 0 0 0 0\nbtime %d\n" % (int(time.time()) - uptime))
+
+    tasks = []
+    pid = FIRST_PID
+    for i in range(num_pids):
+        fds = ["/scratch/user/rank_%d/out_%d" % (i, fd) if fd % 2 else "socket:[%d]" % (pid + fd)
+               for fd in range(fds_per_pid)]
+        tids = list(range(pid, pid + threads_per_pid))
+        make_fake_process(root, pid, "rank_%d" % (i % 64), tids, fds, uptime)
+        tasks.extend(tids)
+        pid += threads_per_pid
+    return tasks
+
+
+def make_fake_cgroups(root, jobs, num_users=8):
+    """
+    Generates fake cpuacct and cpuset hierarchies laid out like Slurm's (slurm/uid_*/job_*/step_*/task_*)
+
+    Parameters
+    ----------
+    root : string
+        path in which to create the cpuacct and cpuset directories
+    jobs : list
+        (tasks, cpus) of every job : tids listed in the tasks file of the job and number of cpus allocated to it
+    num_users : integer
+        number of uid_* directories the jobs are spread over
+
+    Returns
+    -------
+    tuple
+        (cpuacct directory, cpuset directory), to be used as CPUACCT_DIR and CPUSET_DIR
+    """
+    cpuacct_dir = os.path.join(root, "cpuacct", "slurm") + "/"
+    cpuset_dir = os.path.join(root, "cpuset", "slurm") + "/"
+    total_cpus = sum(cpus for tasks, cpus in jobs)
+    first_cpu = 0
+    for i, (tasks, cpus) in enumerate(jobs):
+        uid = "uid_%d" % (1000 + i % num_users)
+        job = "job_%d" % (FIRST_PID + i)
+        job_dir = os.path.join(cpuacct_dir, uid, job)
+        task_dir = os.path.join(job_dir, "step_0", "task_0")
+        os.makedirs(task_dir)
+        write_file(os.path.join(task_dir, "tasks"), "".join("%d\n" % tid for tid in tasks))
+        write_file(os.path.join(job_dir, "cpuacct.usage_percpu"), " ".join(["1000000000"] * total_cpus) + " \n")
+        write_file(os.path.join(job_dir, "cpuacct.usage"), "%d\n" % (cpus * 1000000000))
+        write_file(os.path.join(job_dir, "cpuacct.stat"), "user %d\nsystem %d\n" % (cpus * 90, cpus * 10))
+        os.makedirs(os.path.join(cpuset_dir, uid, job))
+        write_file(os.path.join(cpuset_dir, uid, job, "cpuset.cpus"), "%d-%d\n" % (first_cpu, first_cpu + cpus - 1))
+        first_cpu += cpus
+    return cpuacct_dir, cpuset_dir
+
+
+def psutil_open_files(files, pid):
+    """The open_files jobs_exporter used along with psutil, which stat()s every regular file, kept here for comparison"""
+    retlist = []
+    for fd in files:
+        try:
+            path = os.readlink("%s/%s/fd/%s" % (jobs_exporter.PROCFS_PATH, pid, fd))
+        except FileNotFoundError:
+            continue
+        if path.startswith("/") and (
+            os.path.isfile(path) or path.startswith(("/home", "/project", "/scratch", "/nearline"))
+        ):
+            retlist.append(path)
+    return retlist
+
+
+def next_iteration():
+    """Does what retrieve_and_expose does between two iterations with the data kept for every process"""
+    jobs_exporter.proc_cpu_times_last = jobs_exporter.proc_cpu_times_current
+    jobs_exporter.proc_cpu_times_current = {}
+    jobs_exporter.proc_fd_tables_last = jobs_exporter.proc_fd_tables_current
+    jobs_exporter.proc_fd_tables_current = {}
+
+
+def psutil_get_proc_data(pids, numcpus):
+    """
+    The psutil based process collector jobs_exporter used before reading /proc directly, kept here for comparison.
+    cpu_percent is non-blocking (interval=None) so only the cost of collecting the data is measured.
+    """
+    import psutil
+
+    read_cnt = 0
+    write_cnt = 0
+    read_mbytes = 0
+    write_mbytes = 0
+    opened_files = set()
+    res_set_size = 0
+    cpu_usage = 0
+    threads = {}
+    gpus = set()
+    for pid in pids:
+        p = psutil.Process(pid)
+        name = p.name()
+        env = p.environ()
+        if "SLURM_JOB_GPUS" in env.keys():
+            gpus.update(env["SLURM_JOB_GPUS"])
+        cpu_usage += p.cpu_percent(interval=None)
+        files = os.listdir("%s/%s/fd" % (jobs_exporter.PROCFS_PATH, pid))
+        opened_files.update(psutil_open_files(files, pid))
+        with p.oneshot():
+            read_cnt += p.io_counters()[0]
+            write_cnt += p.io_counters()[1]
+            read_mbytes += p.io_counters()[2] / 1048576
+            write_mbytes += p.io_counters()[3] / 1048576
+            res_set_size += p.memory_info()[0] / 1048576
+            threads[name] = p.num_threads()
+            for file in opened_files:
+                if re.search(".*scratch.*", file[0]):
+                    break
+            for t in p.threads():
+                pids.remove(t[0])
+    return read_cnt, write_cnt, read_mbytes, write_mbytes, res_set_size, threads
+
+
+def list_process_table(pids):
+    """The thread de-duplication jobs_exporter did before build_process_table, kept here for comparison: one
+    list.remove per thread on the list being iterated, which is quadratic and skips pids"""
+    procs = []
+    for pid in pids:
+        try:
+            tids = os.listdir("%s/%s/task" % (jobs_exporter.PROCFS_PATH, pid))
+        except FileNotFoundError:
+            # A skipped thread, threads have no /proc/<tid> directory in the fake procfs
+            continue
+        procs.append(pid)
+        for tid in tids:
+            pids.remove(int(tid))
+    return procs
+
+
+def time_it(func, repeat):
+    """Returns the best wall time of `repeat` calls to func"""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_proc(args):
+    """Compares the psutil collector with the /proc collector on a fake procfs"""
+    root = tempfile.mkdtemp(prefix="jobs_exporter_bench_")
+    try:
+        print("[+] Generating a fake procfs with " + str(args.pids) + " processes in " + root + " [+]")
+        tasks = make_fake_procfs(root, args.pids, args.threads, args.fds)
+        jobs_exporter.PROCFS_PATH = root
+        uptime = jobs_exporter.read_uptime()
+
+        def collect():
+            jobs_exporter.get_proc_data(list(tasks), args.cpus, time.monotonic(), uptime)
+
+        def collect_warm():
+            collect()
+            next_iteration()
+
+        results = {}
+        results["/proc records"] = time_it(collect, args.repeat)
+        # Steady state, the fd tables of the previous iteration are known
+        collect_warm()
+        results["/proc (warm)"] = time_it(collect_warm, args.repeat)
+        try:
+            import psutil
+        except ImportError:
+            print("[-] psutil is not installed, skipping the psutil collector [-]")
+        else:
+            psutil.PROCFS_PATH = root
+            results["psutil"] = time_it(lambda: psutil_get_proc_data(list(tasks), args.cpus), args.repeat)
+
+        for name, elapsed in results.items():
+            print("%-15s %10.3f ms  (%.2f us per process)" % (name, elapsed * 1000, elapsed * 10 ** 6 / args.pids))
+    finally:
+        shutil.rmtree(root)
+
+
+def benchmark_threads(args):
+    """Compares the list based thread de-duplication with the process table on heavily threaded fake processes"""
+    root = tempfile.mkdtemp(prefix="jobs_exporter_bench_")
+    try:
+        print("[+] Generating a fake procfs with " + str(args.pids) + " processes of " + str(args.threads) +
+              " threads in " + root + " [+]")
+        tasks = make_fake_procfs(root, args.pids, args.threads, 0)
+        jobs_exporter.PROCFS_PATH = root
+
+        table = jobs_exporter.build_process_table(tasks)
+        if len(table) != args.pids:
+            print("[-] build_process_table found " + str(len(table)) + " processes instead of " + str(args.pids) + " [-]")
+
+        results = {}
+        results["process table"] = time_it(lambda: jobs_exporter.build_process_table(tasks), args.repeat)
+        results["list.remove"] = time_it(lambda: list_process_table(list(tasks)), args.repeat)
+        for name, elapsed in results.items():
+            print("%-15s %10.3f ms  (%.2f us per thread)" % (name, elapsed * 1000, elapsed * 10 ** 6 / len(tasks)))
+    finally:
+        shutil.rmtree(root)
+
+
+def benchmark_cycle(args):
+    """Runs whole iterations of the exporter on fake cgroup and /proc trees, reporting the cycle time, the memory
+    allocated during a cycle and the peak RSS"""
+    root = tempfile.mkdtemp(prefix="jobs_exporter_bench_")
+    try:
+        print("[+] Generating " + str(args.jobs) + " fake jobs of " + str(args.pids) + " processes of " +
+              str(args.threads) + " thread(s) in " + root + " [+]")
+        os.makedirs(os.path.join(root, "proc"))
+        tasks = make_fake_procfs(os.path.join(root, "proc"), args.jobs * args.pids, args.threads, args.fds)
+        per_job = args.pids * args.threads
+        jobs = [(tasks[i * per_job:(i + 1) * per_job], args.cpus) for i in range(args.jobs)]
+        cpuacct_dir, cpuset_dir = make_fake_cgroups(root, jobs)
+
+        jobs_exporter.PROCFS_PATH = os.path.join(root, "proc")
+        jobs_exporter.CPUACCT_DIR = cpuacct_dir
+        jobs_exporter.CPUSET_DIR = cpuset_dir
+        # No devices cgroup, the GPUs come from the environment of the fake processes
+        jobs_exporter.DEVICES_DIR = os.path.join(root, "devices", "slurm") + "/"
+        backend = jobs_exporter.CgroupV1()
+        pool = ThreadPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+        state = {"snapshot": {}}
+
+        def cycle():
+            state["snapshot"] = jobs_exporter.run_iteration(backend, 15, state["snapshot"], pool)
+
+        # The first cycle finds the jobs and resolves every fd, the next ones are the steady state
+        cold = time_it(cycle, 1)
+        warm = time_it(cycle, args.repeat)
+        if len(state["snapshot"]) != args.jobs:
+            print("[-] The exporter found " + str(len(state["snapshot"])) + " jobs instead of " + str(args.jobs) + " [-]")
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        cycle()
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        diff = after.compare_to(before, "filename")
+        blocks = sum(stat.count_diff for stat in diff)
+
+        print("%-25s %10.3f ms" % ("cycle (cold)", cold * 1000))
+        print("%-25s %10.3f ms  (%.2f us per process)" % ("cycle (warm)", warm * 1000,
+                                                           warm * 10 ** 6 / (args.jobs * args.pids)))
+        print("%-25s %10.1f KB" % ("peak allocated in a cycle", peak / 1024))
+        print("%-25s %10d" % ("blocks kept after a cycle", blocks))
+        # ru_maxrss is in KB on Linux
+        print("%-25s %10.1f MB" % ("peak RSS", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    proc_parser = subparsers.add_parser("proc", help="Compare the psutil and /proc process collectors")
+    proc_parser.add_argument("-p", "--pids", help="Number of fake processes", type=int, default=5000)
+    proc_parser.add_argument("--threads", help="Number of threads per process", type=int, default=1)
+    proc_parser.add_argument("--fds", help="Number of file descriptors per process", type=int, default=4)
+    proc_parser.add_argument("--cpus", help="Number of cpus allocated to the fake job", type=int, default=64)
+    proc_parser.add_argument("-r", "--repeat", help="Number of runs, the best one is kept", type=int, default=3)
+    proc_parser.set_defaults(func=benchmark_proc)
+
+    threads_parser = subparsers.add_parser("threads", help="Compare the thread de-duplications on heavily threaded processes")
+    threads_parser.add_argument("-p", "--pids", help="Number of fake processes", type=int, default=1000)
+    threads_parser.add_argument("--threads", help="Number of threads per process", type=int, default=100)
+    threads_parser.add_argument("-r", "--repeat", help="Number of runs, the best one is kept", type=int, default=3)
+    threads_parser.set_defaults(func=benchmark_threads)
+
+    cycle_parser = subparsers.add_parser("cycle", help="Run whole iterations of the exporter on fake cgroup and /proc trees")
+    cycle_parser.add_argument("-j", "--jobs", help="Number of fake jobs", type=int, default=50)
+    cycle_parser.add_argument("-p", "--pids", help="Number of fake processes per job", type=int, default=40)
+    cycle_parser.add_argument("--threads", help="Number of threads per process", type=int, default=2)
+    cycle_parser.add_argument("--fds", help="Number of file descriptors per process", type=int, default=8)
+    cycle_parser.add_argument("--cpus", help="Number of cpus allocated to each fake job", type=int, default=4)
+    cycle_parser.add_argument("-w", "--workers", help="Number of threads retrieving the jobs' data", type=int, default=1)
+    cycle_parser.add_argument("-r", "--repeat", help="Number of runs, the best one is kept", type=int, default=3)
+    cycle_parser.set_defaults(func=benchmark_cycle)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -6,145 +6,432 @@ __author__ = "Alexandre Larouche"
 
 import os
 import fnmatch
-import re
 import time
 import errno
 import socket
 import stat
 import argparse
 import collections
+import ctypes
+import ctypes.util
+import struct
+import json
+import marshal
+import queue
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from prometheus_client import (
+    Counter,
     Gauge,
+    Histogram,
     start_http_server,
     CollectorRegistry,
     push_to_gateway,
     delete_from_gateway,
 )
+from prometheus_client.core import GaugeMetricFamily
 import signal
 import sys
-import psutil
 import subprocess
 
 # Global Constants
 HOST = socket.gethostname().split(".")[0]  # Get node name
 REGISTRY = CollectorRegistry()
+PUSHGATEWAY = "localhost:9091"
+# Port on which the metrics are served on /metrics in pull mode, None pushes them to the pushgateway instead
+PULL_PORT = None
 BLACKLIST = []
 CPUACCT_DIR = "/sys/fs/cgroup/cpuacct/slurm/"
 CPUSET_DIR = "/sys/fs/cgroup/cpuset/slurm/"
+DEVICES_DIR = "/sys/fs/cgroup/devices/slurm/"
+MEMORY_DIR = "/sys/fs/cgroup/memory/slurm/"
+BLKIO_DIR = "/sys/fs/cgroup/blkio/slurm/"
+# With cgroup v1, read the RSS and I/O of the jobs from the memory and blkio cgroups instead of summing them over the processes
+CGROUP_IO_MEMORY = False
+# cgroup v2 (unified hierarchy), only present at the root of /sys/fs/cgroup when the node runs cgroup v2
+CGROUP2_CONTROLLERS = "/sys/fs/cgroup/cgroup.controllers"
+CGROUP2_DIR = "/sys/fs/cgroup/system.slice/slurmstepd.scope/"
+# cgroup backend to use: "auto", "v1" or "v2"
+CGROUP_VERSION = "auto"
+# Character devices major number of the nvidia driver, minors 254 and 255 are nvidia-modeset and nvidiactl
+NVIDIA_MAJOR = 195
 REGEX = "task_*"
 PROCFS_PATH = '/proc'
-
-sp = Gauge(
-    "jobs_spawned_processes",
-    "Amount of spawned processes by job",
-    ["instance", "slurm_job"],
-    registry=REGISTRY,
-)
-of = Gauge(
-    "jobs_opened_files",
-    "Amount of opened files by job",
-    ["instance", "slurm_job"],
-    registry=REGISTRY,
-)
-tc = Gauge(
-    "jobs_thread_count",
-    "Amount of started thread by job",
-    ["instance", "slurm_job", "proc_name"],
-    registry=REGISTRY,
-)
-st = Gauge(
-    "jobs_system_time",
-    "Amount of time spent in system mode by job",
-    ["instance", "slurm_job"],
-    registry=REGISTRY,
-)
-ut = Gauge(
-    "jobs_user_time",
-    "Amount of time spent in user mode by job",
-    ["instance", "slurm_job"],
-    registry=REGISTRY,
-)
-us = Gauge(
-    "jobs_uses_scratch",
-    "Boolean value, tells if the job uses the scratch fs",
-    ["instance", "slurm_job"],
-    registry=REGISTRY,
-)
-cuc = Gauge(
-    "jobs_cpu_time_core",
-    "Amount of cpu time per cpu allocated to the job (s)",
-    ["instance", "slurm_job", "core"],
-    registry=REGISTRY,
+# Maximum number of file descriptors scanned per job on each iteration, None scans all of them
+FD_SCAN_LIMIT = None
+# Maximum interval (s) between two samples of a job whose metrics are stable, None samples every job on every iteration
+ADAPTIVE_MAX_INTERVAL = None
+# Relative change under which a metric is considered stable
+ADAPTIVE_TOLERANCE = 0.1
+# Number of samples of a new job taken at full rate before backing off
+ADAPTIVE_WARMUP = 4
+# Metrics compared between two samples of a job to tell if it is stable
+ADAPTIVE_METRICS = ("cpu_percent", "rss", "opened_files", "spawned_processes")
+# Spool file keeping the samples of the jobs while the pushgateway can't be reached, None to drop them
+SPOOL_PATH = None
+# Maximum size of the spool and of the backfill files replayed from it (bytes), the oldest samples are dropped past it
+SPOOL_MAX_BYTES = 64 * 1048576
+# Number of spooled iterations replayed in each backfill file
+SPOOL_BATCH = 240
+# Grouping key of the metrics on the pushgateway, which adds it as a label to every series
+PUSH_JOB = "jobs_exporter"
+# Checkpoint of the state of the exporter, reloaded on startup, None to start from scratch
+STATE_PATH = None
+# Version of the checkpoint format, a checkpoint of another version is ignored
+STATE_VERSION = 2
+# Unix socket on which the epilog asks for the final sample of a job, None to not listen
+CONTROL_SOCKET = None
+# Number of seconds a client waits for its request to be served
+CONTROL_TIMEOUT = 60
+# Link targets of file descriptors that are not regular files even if they are absolute paths
+NOT_FILE_PREFIXES = ("/dev/", "/proc/", "/sys/")
+# Filesystems under NOT_FILE_PREFIXES which hold regular files, counted like the old isfile() check did
+FILE_PREFIXES = ("/dev/shm/",)
+# inotify(7) event masks
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+INOTIFY_EVENT = struct.Struct("iIII")
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Metrics exported for every job: name, description, key of the value in the job's data and extra label.
+# When there is an extra label, the value is a dictionnary (label -> value) or a set (labels of value 1).
+JOB_METRICS = (
+    ("jobs_spawned_processes", "Amount of spawned processes by job", "spawned_processes", None),
+    ("jobs_opened_files", "Amount of opened files by job", "opened_files", None),
+    ("jobs_thread_count", "Amount of started thread by job", "threads", "proc_name"),
+    ("jobs_system_time", "Amount of time spent in system mode by job", "system_time", None),
+    ("jobs_user_time", "Amount of time spent in user mode by job", "user_time", None),
+    ("jobs_uses_scratch", "Boolean value, tells if the job uses the scratch fs", "uses_scratch", None),
+    ("jobs_cpu_time_core", "Amount of cpu time per cpu allocated to the job (s)", "cpu_time_core", "core"),
+    ("jobs_cpu_time_total", "Amount of cpu time total for the job (s)", "cpu_time_total", None),
+    ("jobs_read_mb", "Amount of bytes read by the job (MB)", "read_mb", None),
+    ("jobs_write_mb", "Amount of bytes written by the job (MB)", "write_mb", None),
+    ("jobs_read_count", "Amount of reads done by the job", "read_count", None),
+    ("jobs_write_count", "Amount of writes done by the job", "write_count", None),
+    ("jobs_rss", "Resident set size of job (MB)", "rss", None),
+    ("jobs_cpu_percent", "CPU usage of job", "cpu_percent", None),
+    ("jobs_cpu_percent_per_core", "CPU usage per core of job on average", "cpu_percent_per_core", None),
+    ("jobs_gpus_used", "Boolean values representing if the IDs of the gpus are used in the job", "gpus", "gpuid"),
 )
-cut = Gauge(
-    "jobs_cpu_time_total",
-    "Amount of cpu time total for the job (s)",
-    ["instance", "slurm_job"],
+
+iteration_time = Gauge(
+    "jobs_exporter_iteration_seconds",
+    "Wall time spent by the exporter to retrieve and expose the data of every job in the last iteration (s)",
+    ["instance"],
     registry=REGISTRY,
 )
-read = Gauge(
-    "jobs_read_mb",
-    "Amount of bytes read by the job (MB)",
-    ["instance", "slurm_job"],
+# Phases of an iteration, the cgroup read, proc read and fd scan are summed over every job of the iteration
+phase_time = Histogram(
+    "jobs_exporter_phase_seconds",
+    "Wall time spent by the exporter in each phase of an iteration (s)",
+    ["instance", "phase"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
     registry=REGISTRY,
 )
-write = Gauge(
-    "jobs_write_mb",
-    "Amount of bytes written by the job (MB)",
-    ["instance", "slurm_job"],
+pids_visited = Counter(
+    "jobs_exporter_pids_visited",
+    "Number of /proc/<pid> entries read by the exporter",
+    ["instance"],
     registry=REGISTRY,
 )
-read_count = Gauge(
-    "jobs_read_count",
-    "Amount of reads done by the job",
-    ["instance", "slurm_job"],
+fds_visited = Counter(
+    "jobs_exporter_fds_visited",
+    "Number of file descriptors scanned by the exporter",
+    ["instance"],
     registry=REGISTRY,
 )
-write_count = Gauge(
-    "jobs_write_count",
-    "Amount of writes done by the job",
-    ["instance", "slurm_job"],
+vanished_processes = Counter(
+    "jobs_exporter_vanished_processes",
+    "Number of processes which terminated while the exporter was reading them",
+    ["instance"],
     registry=REGISTRY,
 )
-rss = Gauge(
-    "jobs_rss",
-    "Resident set size of job (MB)",
-    ["instance", "slurm_job"],
+push_failures = Counter(
+    "jobs_exporter_push_failures",
+    "Number of pushes to the pushgateway which failed",
+    ["instance"],
     registry=REGISTRY,
 )
-cpu_percent = Gauge(
-    "jobs_cpu_percent", "CPU usage of job", ["instance", "slurm_job"], registry=REGISTRY
-)
-cpu_percent_per_core = Gauge(
-    "jobs_cpu_percent_per_core",
-    "CPU usage per core of job on average",
-    ["instance", "slurm_job"],
-    registry=REGISTRY,
-)
-gpus_gauge = Gauge(
-    "jobs_gpus_used",
-    "Boolean values representing if the IDs of the gpus are used in the job",
-    ["instance", "slurm_job", "gpuid"],
+cycle_overruns = Counter(
+    "jobs_exporter_cycle_overruns",
+    "Number of iterations which took longer than the timer",
+    ["instance"],
     registry=REGISTRY,
 )
 
 # Mappings for jobs
-job_cpus_map = {}
-job_proc_name_map_current = {}
-# For comparing if a process in a job has terminated and therefore needs to be removed from the collectors.
-job_proc_name_map_last = {}
+# pid -> (starttime, cpu ticks, wall clock) of the last sample, used to compute cpu usage as a delta between iterations.
+proc_cpu_times_last = {}
+proc_cpu_times_current = {}
+# pid -> (starttime, {fd: path of the regular file or None}), only new fds are resolved on the next iteration
+proc_fd_tables_last = {}
+proc_fd_tables_current = {}
+# jobid -> set of GPU ids, the GPUs of a job never change so they are only looked up once per job
+job_gpus_map = {}
+# jobid -> projected end time of the job (epoch), None if unknown, looked up once per job
+job_end_time_map = {}
+# jobid -> [next due time (monotonic), interval, number of samples], when adaptive intervals are used
+job_schedule = {}
 
 # Handles SIGINT
 
 
 def sigint_handler(sig, frame):
-    delete_from_gateway("localhost:9091", job="jobs_exporter")
+    delete_pushed_data()
     sys.exit(0)
 
 
 signal.signal(signal.SIGINT, sigint_handler)
 
 
+class JobsCollector:
+    """Collector rendering the jobs' metrics from the snapshot of the last complete iteration. The snapshot is built
+    aside during the iteration and swapped in at the end, so a scrape or a push never sees a half-updated job and the
+    series of a job appear and disappear all at once."""
+
+    def __init__(self):
+        # jobid -> data of the job (see retrieve_file_data), never modified once swapped in
+        self.__snapshot = {}
+
+    def swap(self, snapshot):
+        """Replaces the snapshot by the one built during the iteration that just completed
+
+        Parameters
+        ----------
+        snapshot : dictionnary
+            jobid -> data of the job, must not be modified afterwards
+
+        Returns
+        -------
+        dictionnary
+            the snapshot of the previous iteration
+        """
+        # Replacing the reference is atomic, a collect() running meanwhile keeps rendering the previous snapshot
+        last, self.__snapshot = self.__snapshot, snapshot
+        return last
+
+    def collect(self):
+        snapshot = self.__snapshot
+        for name, documentation, key, label in JOB_METRICS:
+            labels = ["instance", "slurm_job"]
+            if label:
+                labels.append(label)
+            family = GaugeMetricFamily(name, documentation, labels=labels)
+            for jobid, data in snapshot.items():
+                if key not in data:
+                    continue
+                value = data[key]
+                if label is None:
+                    family.add_metric([HOST, jobid], value)
+                elif isinstance(value, dict):
+                    for label_value, sample in value.items():
+                        family.add_metric([HOST, jobid, str(label_value)], sample)
+                else:
+                    for label_value in value:
+                        family.add_metric([HOST, jobid, str(label_value)], 1)
+            yield family
+
+
+JOBS = JobsCollector()
+REGISTRY.register(JOBS)
+
+
+def escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def collect_series(collector):
+    """Renders every sample of a collector as series -> value, series being the name and labels of the sample as in
+    the text exposition format. The job label the pushgateway adds is included, so the backfilled samples land in the
+    same series as the pushed ones (i.e. jobs_rss{instance="node1",job="jobs_exporter",slurm_job="42"})."""
+    series = {}
+    for family in collector.collect():
+        for sample in family.samples:
+            sample_labels = dict(sample.labels, job=PUSH_JOB)
+            labels = ",".join('%s="%s"' % (key, escape_label_value(value)) for key, value in sorted(sample_labels.items()))
+            series["%s{%s}" % (sample.name, labels)] = sample.value
+    return series
+
+
+class MetricSpool:
+    """Append-only ring of the samples that couldn't be pushed. Every line is a JSON record of one iteration holding
+    only the series which changed ("set") or vanished ("del") since the previous record. The ring is made of two
+    segments: once the current one reaches half of the maximum size it replaces the previous one, and starts over with
+    a keyframe holding every series so that each segment can be decoded on its own.
+
+    The pushgateway only keeps the last value of a series and refuses timestamps, so the spooled samples are replayed
+    into OpenMetrics files that have to be backfilled into Prometheus by hand with promtool
+    (promtool tsdb create-blocks-from openmetrics <file> <data dir>). The oldest files are deleted once the spool and
+    the files together exceed the maximum size."""
+
+    def __init__(self, path, max_bytes):
+        self.__path = path
+        self.__max_bytes = max_bytes
+        # series -> value of the last record written, None when the next record has to be a keyframe
+        self.__last = None
+
+    def __segments(self):
+        return [path for path in (self.__path + ".1", self.__path) if os.path.isfile(path)]
+
+    def pending(self):
+        """Tells if there are spooled samples which weren't replayed yet"""
+        return bool(self.__segments())
+
+    def append(self, timestamp, series):
+        """Appends the samples of an iteration
+
+        Parameters
+        ----------
+        timestamp : float
+            time of the iteration (epoch)
+        series : dictionnary
+            series -> value, as returned by collect_series
+        """
+        if self.__last is not None and os.path.getsize(self.__path) >= self.__max_bytes // 2:
+            os.replace(self.__path, self.__path + ".1")
+            self.__last = None
+        if self.__last is None:
+            record = {"t": timestamp, "key": True, "set": series}
+        else:
+            record = {
+                "t": timestamp,
+                "set": {name: value for name, value in series.items() if self.__last.get(name) != value},
+                "del": [name for name in self.__last if name not in series],
+            }
+        with open(self.__path, "a") as spool:
+            spool.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.__last = series
+
+    def __records(self):
+        """Decodes the spooled records, oldest first
+
+        Yields
+        ------
+        tuple
+            (timestamp, series -> value) of every spooled iteration
+        """
+        for path in self.__segments():
+            series = {}
+            with open(path) as spool:
+                for line in spool:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write, the daemon died while appending
+                        continue
+                    if record.get("key"):
+                        series = {}
+                    for name in record.get("del", ()):
+                        series.pop(name, None)
+                    series.update(record["set"])
+                    yield record["t"], series
+
+    def replay(self):
+        """Writes the spooled samples to OpenMetrics files next to the spool, SPOOL_BATCH iterations per file, and
+        empties the spool
+
+        Returns
+        -------
+        list
+            paths of the files written
+        """
+        written = []
+        batch = []
+        records = self.__records()
+        while True:
+            for record in records:
+                # The series are decoded in place, keep a copy of each iteration
+                batch.append((record[0], dict(record[1])))
+                if len(batch) == SPOOL_BATCH:
+                    break
+            if not batch:
+                break
+            written.append(self.__write_batch(batch))
+            batch = []
+        for path in self.__segments():
+            os.remove(path)
+        self.__last = None
+        self.__prune_backfills()
+        return [path for path in written if os.path.isfile(path)]
+
+    def __prune_backfills(self):
+        """Deletes the oldest backfill files until they fit in the maximum size, nothing ingests them on its own"""
+        directory, prefix = os.path.split(self.__path)
+        backfills = []
+        for name in fnmatch.filter(os.listdir(directory or "."), prefix + ".*-*.om"):
+            first = name[len(prefix) + 1:].split("-")[0]
+            if first.isdigit():
+                backfills.append((int(first), os.path.join(directory, name)))
+        backfills.sort()
+        total = sum(os.path.getsize(path) for first, path in backfills)
+        for first, path in backfills:
+            if total <= self.__max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+            print("[-] Deleted the backfill file " + path + " which wasn't ingested, over the maximum spool size [-]")
+
+    def __write_batch(self, batch):
+        """Writes a batch of iterations to an OpenMetrics file, where the samples of a series and the series of a
+        metric have to be grouped together"""
+        # metric name -> series -> samples in time order
+        families = {}
+        for timestamp, series in batch:
+            for name, value in series.items():
+                family = families.setdefault(name.split("{")[0], {})
+                family.setdefault(name, []).append("%s %r %.3f" % (name, value, timestamp))
+        path = "%s.%d-%d.om" % (self.__path, batch[0][0], batch[-1][0])
+        with open(path, "w") as backfill:
+            for family, series in families.items():
+                backfill.write("# TYPE %s gauge\n" % family)
+                for samples in series.values():
+                    backfill.write("\n".join(samples) + "\n")
+            backfill.write("# EOF\n")
+        return path
+
+
+# Created on startup if a spool path is given
+SPOOL = None
+
+
+def push_data():
+    """Pushes the metrics to the pushgateway. If it can't be reached the samples of the jobs are kept in the spool
+    (if there is one), and the spool is replayed on the first push that succeeds."""
+    start = time.monotonic()
+    try:
+        # Pushing replaces every metric of the group on the pushgateway, so the jobs that are done are removed as well
+        push_to_gateway(PUSHGATEWAY,
+                        job=PUSH_JOB, registry=REGISTRY)
+    except OSError as e:
+        # URLError and HTTPError are OSErrors, the daemon keeps going and tries again on the next iteration
+        print("[-] Could not push to " + PUSHGATEWAY + ": " + str(e) + " [-]")
+        push_failures.labels(instance=HOST).inc()
+        if SPOOL is not None:
+            SPOOL.append(time.time(), collect_series(JOBS))
+        return
+    # The duration of a push is exposed on the next one
+    phase_time.labels(instance=HOST, phase="push").observe(time.monotonic() - start)
+    if SPOOL is not None and SPOOL.pending():
+        for path in SPOOL.replay():
+            print("[+] Spooled samples written to " + path + " for backfilling [+]")
+
+
+def delete_pushed_data():
+    """Deletes the data of the exporter from the pushgateway, nothing to do in pull mode"""
+    if PULL_PORT is None:
+        try:
+            delete_from_gateway(PUSHGATEWAY, job=PUSH_JOB)
+        except OSError as e:
+            print("[-] Could not delete the data from " + PUSHGATEWAY + ": " + str(e) + " [-]")
+
+
 def load_blacklist(filename):
     """
     Loads a user list that the program cannot scrape during its process
@@ -160,101 +447,338 @@ def load_blacklist(filename):
         BLACKLIST = blacklist.read().split("\n")
 
 
-def isfile_nfs(path):
-    """Checks if the path is in another filesystem, if so, consider it an opened file descriptor. This function serves to fix the issue
-    where accessing a file through NFS gave `permission denied` because of squash_root."""
-    if path.startswith('/home') or path.startswith('/project') or path.startswith('/scratch') or path.startswith('/nearline'):
-        return True
-    return False
+def is_file_link(link):
+    """Tells if the target of a /proc/<pid>/fd link is a regular file only by looking at its prefix. Sockets, pipes and
+    anonymous inodes are not absolute paths (i.e. socket:[1234]), so nothing has to be stat()ed, which is expensive on
+    NFS/Lustre and gives `permission denied` with squash_root. The device nodes in /dev are left out, but not the files
+    in /dev/shm."""
+    return (
+        link.startswith("/")
+        and (link.startswith(FILE_PREFIXES) or not link.startswith(NOT_FILE_PREFIXES))
+        and not link.endswith(" (deleted)")
+    )
 
 
-def open_files(files, pid):
-    """ Modified version of psutil's open_files to work with squash_root on NFS partition. Basically removes the file opening directly and just reading link"""
+def open_files(fds, pid, starttime, limit=None):
+    """ Modified version of psutil's open_files which only reads links. The fd table of every process is kept between
+    iterations so only the fds that weren't there on the last iteration are resolved with readlink.
+
+    Parameters
+    ----------
+    fds : list
+        fd numbers of the process (entries of /proc/<pid>/fd)
+    pid : integer
+        id of the process
+    starttime : integer
+        start time of the process, a different one means the pid got reused and the kept fd table is discarded
+    limit : integer
+        maximum number of fds to look at, None to look at all of them
+
+    Returns
+    -------
+    list
+        paths of the regular files opened by the process
+    """
+    last = proc_fd_tables_last.get(pid)
+    last_table = last[1] if last is not None and last[0] == starttime else {}
+    table = {}
     retlist = []
-    for fd in files:
-        file = "%s/%s/fd/%s" % (PROCFS_PATH, pid, fd)
-        try:
-            path = os.readlink(file)
-        except (FileNotFoundError, ProcessLookupError):
-            # ENOENT == file which is gone in the meantime
-            continue
-        except OSError as err:
-            if err.errno == errno.EINVAL:
-                # not a link
-                continue
-            raise
+    if limit is not None:
+        fds = fds[:limit]
+    for fd in fds:
+        if fd in last_table:
+            path = last_table[fd]
         else:
-            # If file is a regular file, it has an absolute file name - taken from psutil, just removed the with open() part so we dont throw an error on NFS mounted partitions
-            if path.startswith('/') and (os.path.isfile(path) or isfile_nfs(path)):
-                # Get file position and flags.
-                retlist.append(path)
+            file = "%s/%s/fd/%s" % (PROCFS_PATH, pid, fd)
+            try:
+                link = os.readlink(file)
+            except (FileNotFoundError, ProcessLookupError):
+                # ENOENT == file which is gone in the meantime
+                continue
+            except OSError as err:
+                if err.errno == errno.EINVAL:
+                    # not a link
+                    continue
+                raise
+            path = link if is_file_link(link) else None
+        table[fd] = path
+        if path is not None:
+            retlist.append(path)
+    proc_fd_tables_current[pid] = (starttime, table)
     return retlist
 
 
-def remove_old_procs(cur_map, last_map, jobid):
-    """Remove a PROCESS (not job) which was there in the last iteration but isn't appearing in the newest iteration of the scraping
+class ProcRecord:
+    """Data read once from /proc/<pid>/{stat,status,io,statm} for a process. Every exported metric of the process is derived from it."""
+
+    __slots__ = (
+        "pid",
+        "tgid",
+        "name",
+        "num_threads",
+        "cpu_ticks",
+        "starttime",
+        "rss",
+        "read_count",
+        "write_count",
+        "read_bytes",
+        "write_bytes",
+    )
+
+
+def read_proc_record(pid, io=True, memory=True):
+    """Reads the data of a process directly from /proc (replaces the psutil.Process calls)
 
     Parameters
     ----------
-    cur_map : dictionnary
-        job -> proc mapping for the current iteration
-    last_map : dictionnary
-        job -> proc mapping for the last iteration (just before cur_map)
-    jobid : integer
-        id of the job that is being verified
+    pid : integer
+        id of the process to read
+    io : boolean
+        read the I/O of the process (io), not needed when the cgroups give it for the whole job
+    memory : boolean
+        read the RSS of the process (statm), not needed when the cgroups give it for the whole job
+
+    Returns
+    -------
+    ProcRecord
+        data of the process
+
+    Raises
+    ------
+    FileNotFoundError, ProcessLookupError
+        if the process terminated while it was being read
     """
-    for proc in last_map:
-        if proc not in cur_map:
-            tc.remove(HOST, jobid, proc)
+    record = ProcRecord()
+    record.pid = pid
+    proc_dir = "%s/%s/" % (PROCFS_PATH, pid)
+
+    with open(proc_dir + "stat", "rb") as stat_file:
+        data = stat_file.read()
+    # The process name can contain spaces and parentheses, so only split what comes after the last ')'
+    fields = data[data.rfind(b")") + 2:].split()
+    # Fields are offset by 3 (pid, comm and state are not in the list), see proc(5) for utime (14), stime (15), num_threads (20) and starttime (22)
+    record.cpu_ticks = int(fields[11]) + int(fields[12])
+    record.num_threads = int(fields[17])
+    record.starttime = int(fields[19])
+
+    with open(proc_dir + "status", "rb") as status_file:
+        for line in status_file:
+            if line.startswith(b"Name:"):
+                record.name = line[5:].strip().decode(errors="replace")
+            elif line.startswith(b"Tgid:"):
+                record.tgid = int(line[5:])
+                break
+
+    # The kernel truncates names to 15 characters, use the command line to get the full name like psutil does
+    if len(record.name) >= 15:
+        with open(proc_dir + "cmdline", "rb") as cmdline_file:
+            exe = os.path.basename(cmdline_file.read().split(b"\0", 1)[0]).decode(errors="replace")
+        if exe.startswith(record.name):
+            record.name = exe
+
+    if memory:
+        with open(proc_dir + "statm", "rb") as statm_file:
+            record.rss = int(statm_file.read().split()[1]) * PAGE_SIZE
+
+    if io:
+        counters = {}
+        with open(proc_dir + "io", "rb") as io_file:
+            for line in io_file:
+                key, value = line.split(b":")
+                counters[key] = int(value)
+        record.read_count = counters[b"syscr"]
+        record.write_count = counters[b"syscw"]
+        record.read_bytes = counters[b"read_bytes"]
+        record.write_bytes = counters[b"write_bytes"]
+
+    return record
+
+
+def read_environ(pid):
+    """Reads the environment variables of a process from /proc/<pid>/environ
+
+    Returns
+    -------
+    dictionnary
+        environment variable name -> value
+    """
+    with open("%s/%s/environ" % (PROCFS_PATH, pid), "rb") as environ_file:
+        data = environ_file.read()
+    env = {}
+    for entry in data.split(b"\0"):
+        key, sep, value = entry.partition(b"=")
+        if sep:
+            env[key.decode(errors="replace")] = value.decode(errors="replace")
+    return env
+
+
+def get_cpu_percent(record, now, uptime):
+    """Computes the cpu usage of a process without sleeping, by comparing its cpu time with the one kept from the last iteration.
+    A process seen for the first time gets its average usage since it started.
+
+    Parameters
+    ----------
+    record : ProcRecord
+        data of the process read from /proc
+    now : float
+        wall clock time of the current iteration
+    uptime : float
+        system uptime in seconds (first field of /proc/uptime) for the current iteration
+
+    Returns
+    -------
+    float
+        cpu usage of the process in percent (may be over 100% for multithreaded processes)
+    """
+    pid, ticks, starttime = record.pid, record.cpu_ticks, record.starttime
+    proc_cpu_times_current[pid] = (starttime, ticks, now)
+
+    last = proc_cpu_times_last.get(pid)
+    # A different starttime means the pid got reused by another process since the last iteration
+    if last is not None and last[0] == starttime and now > last[2]:
+        return ((ticks - last[1]) / CLK_TCK) / (now - last[2]) * 100
+
+    lifetime = uptime - starttime / CLK_TCK
+    if lifetime <= 0:
+        return 0.0
+    return (ticks / CLK_TCK) / lifetime * 100
+
+
+def read_uptime():
+    """Returns the system uptime in seconds from /proc/uptime"""
+    with open("%s/uptime" % PROCFS_PATH) as uptime_file:
+        return float(uptime_file.readline().split()[0])
+
+
+def read_boot_time():
+    """Returns the boot time of the system (epoch) from /proc/stat, it tells if pids are from the current boot"""
+    with open("%s/stat" % PROCFS_PATH) as stat_file:
+        for line in stat_file:
+            if line.startswith("btime "):
+                return int(line.split()[1])
+    return None
 
 
-def remove_inactive_jobs_from_collectors(jobid):
-    """Removes jobs that are done from the collectors so we don't keep pushing them
+def forget_inactive_job(jobid):
+    """Forgets what is kept about a job that is done. Its metrics vanish by themselves since it isn't in the snapshot anymore.
 
     Parameters
     ----------
     jobid: integer
-        id of the job we want to delete from the collectors
+        id of the job that is done
     """
-    sp.remove(HOST, jobid)
-    of.remove(HOST, jobid)
-    st.remove(HOST, jobid)
-    ut.remove(HOST, jobid)
-    us.remove(HOST, jobid)
-    cut.remove(HOST, jobid)
-    read.remove(HOST, jobid)
-    write.remove(HOST, jobid)
-    read_count.remove(HOST, jobid)
-    write_count.remove(HOST, jobid)
-    rss.remove(HOST, jobid)
-    cpu_percent.remove(HOST, jobid)
-    cpu_percent_per_core.remove(HOST, jobid)
-
-    # Remove current processes from the collector for this job
-    for proc_name in job_proc_name_map_current[jobid]:
-        tc.remove(HOST, jobid, proc_name)
-
-    # Remove allocated CPUs from the collector for this job
-    for cpu in job_cpus_map[jobid]:
-        cuc.remove(HOST, jobid, cpu)
-
-
-def get_proc_data(pids, numcpus, jobid):
+    job_gpus_map.pop(jobid, None)
+    job_end_time_map.pop(jobid, None)
+    job_schedule.pop(jobid, None)
+
+
+def read_job_gpus(user, job):
+    """Finds the GPUs allocated to a job from the devices cgroup, which Slurm constrains when ConstrainDevices=yes
+
+    Parameters
+    ----------
+    user: string
+        username to find the right cgroup
+    job: string
+        job name to find cgroup
+
+    Returns
+    -------
+    set or None
+        ids of the GPUs (nvidia minor numbers) the job is allowed to use, None if the devices cgroup can't tell
+    """
+    gpus = set()
+    try:
+        with open(DEVICES_DIR + user + "/" + job + "/devices.list") as devices_file:
+            for line in devices_file:
+                # Lines look like "c 195:0 rwm", "a *:* rwm" means every device is allowed (no constraint)
+                dev_type, dev, access = line.split()
+                if dev_type == "a":
+                    return None
+                major, minor = dev.split(":")
+                if major == str(NVIDIA_MAJOR) and minor != "*" and int(minor) < 254:
+                    gpus.add(minor)
+    except FileNotFoundError:
+        return None
+    return gpus
+
+
+def build_process_table(tasks, io=True, memory=True, costs=None):
+    """Groups the tids listed by the cgroup by process (thread group) and reads every process once. A tid is only
+    read if its thread group wasn't seen yet, so each process costs one read of its data and one listing of its
+    threads whatever its number of threads.
+
+    Parameters
+    ----------
+    tasks : list
+        tids listed by the cgroup, processes and their threads
+    io : boolean
+        read the I/O of the processes
+    memory : boolean
+        read the RSS of the processes
+    costs : collections.Counter
+        incremented with the number of pids read ("pids") and of processes which vanished ("vanished")
+
+    Returns
+    -------
+    dictionnary
+        tgid -> ProcRecord of the process
     """
-    Retrieves processes data for a given job id
+    if costs is None:
+        costs = collections.Counter()
+    table = {}
+    seen = set()
+    for tid in tasks:
+        if tid in seen:
+            continue
+        try:
+            costs["pids"] += 1
+            record = read_proc_record(tid, io, memory)
+            # A thread listed before its process, the data of the process is the one of its main thread
+            if record.tgid != tid:
+                costs["pids"] += 1
+                record = read_proc_record(record.tgid, io, memory)
+            tids = os.listdir("%s/%s/task" % (PROCFS_PATH, record.pid))
+        except (FileNotFoundError, ProcessLookupError):
+            # The process terminated since the tasks file was read
+            costs["vanished"] += 1
+            continue
+        seen.update(map(int, tids))
+        # The tid may already be gone from the listing if the thread just exited
+        seen.add(tid)
+        table[record.pid] = record
+    return table
+
+
+def get_proc_data(pids, numcpus, now, uptime, find_environ=False, io=True, memory=True, costs=None):
+    """
+    Retrieves processes data for a given job
 
     Parameters
     ----------
     pids : array
-        list of process ids that needs checking for data
+        list of process and thread ids that needs checking for data, as listed by the cgroup
     numcpus : integer
         number of cpus allocated to the job
-    jobid : integer
-        id of the job that possesses the processes
+    now : float
+        wall clock time of the current iteration
+    uptime : float
+        system uptime in seconds for the current iteration
+    find_environ : boolean
+        read the environment of the first readable process, for what isn't known about the job yet (GPUs, end time)
+    io : boolean
+        sum the I/O of the processes, False when the cgroups already give it for the whole job
+    memory : boolean
+        sum the RSS of the processes, False when the cgroups already give it for the whole job
+    costs : collections.Counter
+        incremented with what reading the processes cost: pids read, processes which vanished, fds scanned ("fds") and
+        time spent scanning them ("fd_seconds")
+
+    Returns
+    -------
+    dictionnary
+        aggregated process data of the job (I/O, rss, cpu usage, threads per process name, pids, environ if asked, ...)
     """
-    # Set jobs_uses_scratch to false here so in case no fildes links to scratch fs, it is already handled.
-    us.labels(instance=HOST, slurm_job=jobid).set(0)
-
     # Aggregators for processes
     read_cnt = 0
     write_cnt = 0
@@ -264,229 +788,993 @@ def get_proc_data(pids, numcpus, jobid):
     res_set_size = 0
     cpu_usage = 0
     cpu_usage_per_core = 0  # On average
-    proc_names = []
-    gpus = set()
-
-    for pid in pids:
-        p = psutil.Process(pid)
-        name = p.name()
-        proc_names.append(name)
-        env = p.environ()
-
-        if "SLURM_JOB_GPUS" in env.keys():
-            gpus.update(env["SLURM_JOB_GPUS"])
-        # Request cpu percent out of the "oneshot" below so it's queried properly
-        cpu_usage += p.cpu_percent(interval=0.1)
-
-        cpu_usage_per_core += cpu_usage / numcpus
-
-        files = os.listdir("%s/%s/fd" % (PROCFS_PATH, pid))
-        files = open_files(files, pid)
-        opened_files.update(files)
-
-        with p.oneshot():
-            # Get data from the process with psutil
-            read_cnt += p.io_counters()[0]
-            write_cnt += p.io_counters()[1]
-            read_mbytes += p.io_counters()[2] / 1048576  # In MB
-            write_mbytes += p.io_counters()[3] / 1048576  # In MB
-            res_set_size += p.memory_info()[0] / 1048576  # In MB
-            threads = p.num_threads()
-
-            tc.labels(instance=HOST, slurm_job=jobid,
-                      proc_name=name).set(threads)
-
-            # Looks for scratch usage in the opened files
-            for file in opened_files:
-                if re.search(".*scratch.*", file[0]):
-                    us.labels(instance=HOST, slurm_job=jobid).set(
-                        1
-                    )  # Sets the state to true, the user is confirmed to be using scratch fs to write.
-                    break
+    uses_scratch = 0
+    threads = {}
+    environ = None
+    # Number of fds that can still be scanned for this job
+    fd_budget = FD_SCAN_LIMIT
+    if costs is None:
+        costs = collections.Counter()
+
+    table = build_process_table(pids, io, memory, costs)
+    for pid, record in table.items():
+        fd_start = time.monotonic()
+        try:
+            # The environment is the same for every process of the job, read it once
+            if find_environ and environ is None:
+                environ = read_environ(pid)
+            if fd_budget is None or fd_budget > 0:
+                files = os.listdir("%s/%s/fd" % (PROCFS_PATH, pid))
+            else:
+                files = []
+        except (FileNotFoundError, ProcessLookupError):
+            # The process terminated since the tasks file was read
+            costs["vanished"] += 1
+            continue
 
-            # Remove already encountered pids as threads from the pid list
-            for p in p.threads():
-                pids.remove(p[0])
+        if files:
+            opened_files.update(open_files(files, pid, record.starttime, fd_budget))
+            scanned = len(files) if fd_budget is None else min(len(files), fd_budget)
+            if fd_budget is not None:
+                fd_budget -= scanned
+            costs["fds"] += scanned
+        costs["fd_seconds"] += time.monotonic() - fd_start
+
+        # Delta of cpu ticks since the last iteration, no sleeping involved
+        proc_cpu_usage = get_cpu_percent(record, now, uptime)
+        cpu_usage += proc_cpu_usage
+
+        cpu_usage_per_core += proc_cpu_usage / numcpus
+
+        if io:
+            read_cnt += record.read_count
+            write_cnt += record.write_count
+            read_mbytes += record.read_bytes / 1048576  # In MB
+            write_mbytes += record.write_bytes / 1048576  # In MB
+        if memory:
+            res_set_size += record.rss / 1048576  # In MB
+        threads[record.name] = record.num_threads
+
+    # Looks for scratch usage in the opened files, once for the whole job
+    for file in opened_files:
+        if "scratch" in file:
+            # Sets the state to true, the user is confirmed to be using scratch fs to write.
+            uses_scratch = 1
+            break
+
+    data = {
+        "opened_files": len(opened_files),
+        "cpu_percent": cpu_usage,
+        "cpu_percent_per_core": cpu_usage_per_core,
+        "uses_scratch": uses_scratch,
+        "threads": threads,
+        # Used to keep the data of the processes when the job isn't sampled on an iteration
+        "pids": list(table),
+    }
+    if io:
+        data["read_mb"] = read_mbytes
+        data["write_mb"] = write_mbytes
+        data["read_count"] = read_cnt
+        data["write_count"] = write_cnt
+    if memory:
+        data["rss"] = res_set_size
+    if environ is not None:
+        data["environ"] = environ
+    return data
+
+
+def retrieve_file_data(backend, jobid, handle, now, uptime):
+    """Retrieves the data stored in different files within the cgroups. If tasks
+    are found, retrieve the process data (cpu%, cputime, R/W counts,...) associated
+    with said tasks.
 
-    # Keep the job -> proc_name map up to date. Useful to remove old jobs from the pushgateway.
-    job_proc_name_map_current[jobid] = proc_names
+    This function only reads data and does not touch the collectors, so it can run in a worker thread.
 
-    # Insures there has been at least one iteration before comparing if a process has terminated (in order not to crash the program)
-    if jobid in job_proc_name_map_last:
-        remove_old_procs(
-            job_proc_name_map_current[jobid], job_proc_name_map_last[jobid], jobid
+    Parameters
+    ----------
+    backend : CgroupV1 or CgroupV2
+        cgroup backend which found the job
+    jobid: integer
+        jobid for collector labels
+    handle : object
+        what the backend needs to find the cgroups of the job, as returned by its discover()
+    now : float
+        wall clock time of the current iteration
+    uptime : float
+        system uptime in seconds for the current iteration
+
+    Returns
+    -------
+    tuple
+        (jobid, data) : data is a dictionnary of everything that was found for the job, to be given to add_to_snapshot,
+        along with what retrieving it cost ("costs"). data is None if the job ended since it was found.
+    """
+    costs = collections.Counter()
+    start = time.monotonic()
+    try:
+        data = backend.read_job(handle)
+    except (FileNotFoundError, IndexError):
+        # The cgroups of the job were removed while being read
+        return jobid, None
+    tasks = data.pop("tasks")
+    data["spawned_processes"] = len(tasks)
+
+    # The GPUs only need to be found once per job, from the cgroups if possible
+    find_gpus = jobid not in job_gpus_map
+    if find_gpus:
+        gpus = backend.read_gpus(handle)
+        if gpus is not None:
+            data["gpus"] = gpus
+            find_gpus = False
+    costs["cgroup_seconds"] += time.monotonic() - start
+    # The end time is only needed to sample the jobs near their end at full rate
+    find_end_time = ADAPTIVE_MAX_INTERVAL is not None and jobid not in job_end_time_map
+
+    # Get process-specific data from /proc if tasks list isn't empty. The RSS and I/O are only summed over the
+    # processes if the cgroups didn't already give them for the whole job.
+    if tasks:
+        start = time.monotonic()
+        data.update(
+            get_proc_data(
+                tasks, len(data["cpus"]), now, uptime, find_gpus or find_end_time, "read_mb" not in data, "rss" not in data,
+                costs,
+            )
         )
-    job_proc_name_map_last[jobid] = proc_names
+        # The fd scan is accounted on its own
+        costs["proc_seconds"] += time.monotonic() - start - costs["fd_seconds"]
 
-    # Put data in collectors
-    of.labels(instance=HOST, slurm_job=jobid).set(len(set(opened_files)))
-    read.labels(instance=HOST, slurm_job=jobid).set(read_mbytes)
-    write.labels(instance=HOST, slurm_job=jobid).set(write_mbytes)
-    read_count.labels(instance=HOST, slurm_job=jobid).set(read_cnt)
-    write_count.labels(instance=HOST, slurm_job=jobid).set(write_cnt)
-    rss.labels(instance=HOST, slurm_job=jobid).set(res_set_size)
-    cpu_percent_per_core.labels(
-        instance=HOST, slurm_job=jobid).set(cpu_usage_per_core)
-    cpu_percent.labels(instance=HOST, slurm_job=jobid).set(cpu_usage)
+    environ = data.pop("environ", None)
+    if environ is not None:
+        if find_gpus:
+            data["gpus"] = set(filter(None, environ.get("SLURM_JOB_GPUS", "").split(",")))
+        if find_end_time:
+            end_time = environ.get("SLURM_JOB_END_TIME")
+            data["end_time"] = int(end_time) if end_time else None
 
-    for gpu in gpus:
-        gpus_gauge.labels(instance=HOST, slurm_job=jobid, gpuid=gpu).set(1)
+    data["costs"] = costs
+    return jobid, data
 
 
-def retrieve_file_data(job, jobid, user, dirname):
-    """Retrieves the data stored in different files within the cgroups. If tasks
-    are found, retrieve the process data (cpu%, cputime, R/W counts,...) associated
-    with said tasks.
+def is_stable(last_data, data):
+    """Tells if the metrics of a job barely changed between two samples
 
     Parameters
     ----------
-    job: string
-        job name to find cgroup
-    jobid: integer
-        jobid for collector labels
-    user: string
-        username to find the right cgroup
-    dirname: string
-        full name of the path to find tasks
+    last_data : dictionnary
+        data of the job on its previous sample
+    data : dictionnary
+        data of the job on this sample
+    """
+    for key in ADAPTIVE_METRICS:
+        if key not in data or key not in last_data:
+            return False
+        if abs(data[key] - last_data[key]) > ADAPTIVE_TOLERANCE * max(abs(last_data[key]), 1):
+            return False
+    return True
+
+
+def is_due(jobid, now):
+    """Tells if a job has to be sampled on this iteration, every job is when adaptive intervals aren't used"""
+    entry = job_schedule.get(jobid)
+    return entry is None or now >= entry[0]
 
+
+def reschedule(jobid, last_data, data, now, timer):
+    """Sets when a job that was just sampled has to be sampled next. The interval doubles each time the job is found
+    stable, up to ADAPTIVE_MAX_INTERVAL, and goes back to the timer as soon as it changes. New jobs and jobs near their
+    end are always sampled at full rate.
+
+    Parameters
+    ----------
+    jobid : integer
+        id of the job
+    last_data : dictionnary
+        data of the job on its previous sample, None if it is new
+    data : dictionnary
+        data of the job on this sample
+    now : float
+        wall clock time (monotonic) of the current iteration
+    timer : integer
+        number of seconds between two iterations, the shortest interval
+    """
+    interval, samples = job_schedule.get(jobid, (None, timer, 0))[1:]
+    samples += 1
+    end_time = job_end_time_map.get(jobid)
+    near_end = end_time is not None and end_time - time.time() <= ADAPTIVE_MAX_INTERVAL
+    if samples <= ADAPTIVE_WARMUP or near_end or last_data is None or not is_stable(last_data, data):
+        interval = timer
+    else:
+        interval = min(interval * 2, ADAPTIVE_MAX_INTERVAL)
+    job_schedule[jobid] = [now + interval, interval, samples]
+
+
+def add_to_snapshot(snapshot, jobid, data):
+    """Adds the data retrieved for a job to the snapshot being built. Always called from the main loop so the
+    job mappings are only modified from one thread.
+
+    Parameters
+    ----------
+    snapshot : dictionnary
+        jobid -> data of the job for the current iteration
+    jobid : integer
+        id of the job
+    data : dictionnary
+        data returned by retrieve_file_data for this job
     """
-    # Declarations
-    tasks = []
-    times = []
+    if "gpus" in data:
+        job_gpus_map[jobid] = data["gpus"]
+    else:
+        data["gpus"] = job_gpus_map.get(jobid, set())
+    if "end_time" in data:
+        job_end_time_map[jobid] = data.pop("end_time")
+    snapshot[jobid] = data
+
+
+class DirectoryWatcher:
+    """Uses inotify to tell which watched directories had entries created or removed since the last check.
+    Directory mtimes can't be used for this since cgroupfs doesn't update them when a cgroup is created or removed."""
+
+    def __init__(self):
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.__fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # watch descriptor -> path
+        self.__watches = {}
+
+    def watch(self, path):
+        """Starts watching a directory, returns False if it could not be watched"""
+        wd = self.__libc.inotify_add_watch(
+            self.__fd,
+            os.fsencode(path),
+            IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR,
+        )
+        if wd < 0:
+            return False
+        self.__watches[wd] = path
+        return True
+
+    def changed(self):
+        """Reads the pending events without blocking
+
+        Returns
+        -------
+        tuple or None
+            (paths of the watched directories that changed, paths of the directories that are no longer watched), None
+            if events were lost and everything must be listed again
+        """
+        changed = set()
+        ignored = set()
+        while True:
+            try:
+                buf = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                return changed, ignored
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+                offset += INOTIFY_EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    # The directory was removed, the kernel already dropped the watch. It may be created again
+                    # before the next check, so the caller has to watch it anew.
+                    if wd in self.__watches:
+                        ignored.add(self.__watches.pop(wd))
+                elif wd in self.__watches:
+                    changed.add(self.__watches[wd])
+
+
+class JobIndex:
+    """Keeps the uid_*/job_* cgroups found in the cpuacct hierarchy between iterations. Only the directories
+    where jobs were added or removed are listed again, instead of walking the whole tree every iteration."""
+
+    def __init__(self, root):
+        self.__root = root
+        # uid directory -> set of job directories
+        self.__uids = {}
+        # job directory -> task directory (None while the job has no task yet)
+        self.__jobs = {}
+        # Directories which could not be watched are listed on every iteration
+        self.__unwatched = {root}
+        try:
+            self.__watcher = DirectoryWatcher()
+        except (OSError, AttributeError):
+            print("[-] inotify is unavailable, listing the uid and job cgroups on every iteration [-]")
+            self.__watcher = None
+
+    def __list(self, path, pattern):
+        """Lists the directories matching a pattern in path and starts watching path if it isn't already"""
+        # Watched before listing, so an entry created in between isn't missed
+        if path in self.__unwatched and self.__watcher and self.__watcher.watch(path):
+            self.__unwatched.discard(path)
+        try:
+            entries = os.listdir(path)
+        except FileNotFoundError:
+            return set()
+        return {os.path.join(path, d) for d in fnmatch.filter(entries, pattern)}
+
+    def __forget_uid(self, uid_dir):
+        for job_dir in self.__uids.pop(uid_dir):
+            del self.__jobs[job_dir]
+        self.__unwatched.discard(uid_dir)
+
+    def discover(self):
+        """Finds the jobs currently in the cgroup hierarchy
+
+        Returns
+        -------
+        list
+            (uid directory, job directory, task directory) for every job that has at least one task
+        """
+        events = self.__watcher.changed() if self.__watcher else (set(), set())
+        if events is None:
+            # The removed directories are unknown too, every directory is watched again
+            self.__unwatched |= {self.__root} | set(self.__uids)
+            dirty = {self.__root} | set(self.__uids)
+        else:
+            changed, ignored = events
+            # Directories removed then created again keep their path, they are listed and watched again
+            self.__unwatched |= ignored & ({self.__root} | set(self.__uids))
+            dirty = changed | self.__unwatched
+
+        if self.__root in dirty:
+            uid_dirs = self.__list(self.__root, "uid_*")
+            for uid_dir in set(self.__uids) - uid_dirs:
+                self.__forget_uid(uid_dir)
+            for uid_dir in uid_dirs - set(self.__uids):
+                self.__uids[uid_dir] = set()
+                self.__unwatched.add(uid_dir)
+                dirty.add(uid_dir)
+
+        for uid_dir in dirty & set(self.__uids):
+            job_dirs = self.__list(uid_dir, "job_*")
+            for job_dir in self.__uids[uid_dir] - job_dirs:
+                del self.__jobs[job_dir]
+            for job_dir in job_dirs - self.__uids[uid_dir]:
+                self.__jobs[job_dir] = None
+            self.__uids[uid_dir] = job_dirs
+
+        found = []
+        for uid_dir, job_dirs in self.__uids.items():
+            for job_dir in job_dirs:
+                task_dir = self.__jobs[job_dir]
+                # Steps come and go during a job, so look for a task again if the one we had is gone
+                if task_dir is None or not os.path.isdir(task_dir):
+                    task_dir = self.__jobs[job_dir] = find_task_dir(job_dir)
+                if task_dir is not None:
+                    found.append((uid_dir, job_dir, task_dir))
+        return found
+
+
+def find_task_dir(job_dir):
+    """Returns the first directory matching REGEX (global constant, default is "task_*") under a job's cgroup, None if there is none"""
+    for path, dirs, files in os.walk(job_dir):
+        for f in fnmatch.filter(dirs, REGEX):
+            return os.path.join(path, f)
+    return None
+
+
+def parse_cpu_list(cpu_list):
+    """Parses a list of cpus in the cpuset format (i.e. 0-3,8,10-11) into a list of cpu numbers"""
     cpus = []
+    for alloc in cpu_list.strip().split(","):
+        if "-" in alloc:
+            alloc = alloc.split("-")
+            for i in range(int(alloc[0]), int(alloc[1]) + 1):
+                cpus.append(i)
+        elif alloc:
+            cpus.append(int(alloc))
+    return cpus
+
+
+def read_key_values(path):
+    """Reads a flat keyed cgroup file (i.e. cpu.stat, memory.stat) into a dictionnary of integers"""
+    values = {}
+    with open(path) as key_file:
+        for line in key_file:
+            key, value = line.split()
+            values[key] = int(value)
+    return values
+
+
+def read_blkio_totals(path):
+    """Sums the per device lines of a cgroup v1 blkio file (i.e. "8:0 Read 4096")
+
+    Returns
+    -------
+    collections.Counter or None
+        operation (Read, Write, ...) -> total over every device, None if the file doesn't exist
+    """
+    totals = collections.Counter()
+    try:
+        with open(path) as blkio_file:
+            for line in blkio_file:
+                fields = line.split()
+                # The last line is "Total <value>"
+                if len(fields) == 3:
+                    totals[fields[1]] += int(fields[2])
+    except FileNotFoundError:
+        return None
+    return totals
+
+
+class CgroupV1:
+    """Slurm jobs in the cgroup v1 hierarchies (cpuacct, cpuset and devices), laid out as uid_*/job_*/step_*/task_*"""
+
+    def __init__(self):
+        self.__index = JobIndex(CPUACCT_DIR.rstrip("/"))
+
+    def discover(self):
+        """Finds the jobs currently running
+
+        Returns
+        -------
+        list
+            (jobid, uid, handle) for every job, handle is what read_job and read_gpus need to find the cgroups of the job
+        """
+        jobs = []
+        for uid_dir, job_dir, task_dir in self.__index.discover():
+            job = os.path.basename(job_dir)  # Used for file names
+            user = os.path.basename(uid_dir)  # Used for file names
+            jobs.append((job.split("_")[1], user.split("_")[1], (job, user, task_dir)))
+        return jobs
+
+    def find_job(self, jobid, uid=None):
+        """Finds a job from the path of its cgroups, even if it has no task left, unlike discover
+
+        Parameters
+        ----------
+        jobid : string
+            id of the job
+        uid : string
+            uid of the job's user, None to look for the job under every user
+
+        Returns
+        -------
+        tuple or None
+            handle of the job for read_job, the task directory being None if there is none, None if the job has no
+            cgroup
+        """
+        job = "job_" + jobid
+        if uid is not None:
+            users = ["uid_" + uid]
+        else:
+            try:
+                users = fnmatch.filter(os.listdir(CPUACCT_DIR), "uid_*")
+            except FileNotFoundError:
+                users = []
+        for user in users:
+            job_dir = CPUACCT_DIR + user + "/" + job
+            if os.path.isdir(job_dir):
+                return job, user, find_task_dir(job_dir)
+        return None
+
+    def read_job(self, handle):
+        """Reads the data of a job from its cgroups
+
+        Returns
+        -------
+        dictionnary
+            cpus, cpu times and tasks (pids and tids) of the job
+        """
+        job, user, dirname = handle
+        # Declarations
+        tasks = []
+        times = []
+        data = {"cpus": [], "cpu_time_core": {}}
+
+        # Semi-static paths which change depending on user and job. Control groups.
+        cpuset_path = CPUSET_DIR + user + "/" + job + "/cpuset.cpus"
+        usage_percpu_path = CPUACCT_DIR + user + "/" + job + "/cpuacct.usage_percpu"
+        usage_total_path = CPUACCT_DIR + user + "/" + job + "/cpuacct.usage"
+        stat_path = CPUACCT_DIR + user + "/" + job + "/cpuacct.stat"
+        # A job found by find_job may have no task directory left
+        task_path = dirname + "/tasks" if dirname is not None else None
+
+        # Look for which CPUs got allocated to this job
+        if os.path.isfile(cpuset_path):
+            with open(cpuset_path) as cpuset_file:
+                data["cpus"] = parse_cpu_list(cpuset_file.readline())
+
+        # Cross-reference the allocated CPUs with their individual usages in nanoseconds
+        if os.path.isfile(usage_percpu_path):
+            with open(usage_percpu_path) as cpuacct_file:
+                usage_data = cpuacct_file.readline().rstrip().split(" ")
+                for cpu in data["cpus"]:
+                    # Divide the usage by 10 ** 9 because it's in nanoseconds (to send them to Prometheus is seconds).
+                    data["cpu_time_core"][cpu] = int(usage_data[cpu]) / 10 ** 9
+
+        # Gets total cpu time spent for this job. Will be used to compare loads on each cpu to the total time spent (load balancing)
+        if os.path.isfile(usage_total_path):
+            with open(usage_total_path) as cpuacct_file:
+                # Divide usage by 10**9 because it's in nanoseconds (to send them to Prometheus in seconds).
+                data["cpu_time_total"] = int(cpuacct_file.readline().rstrip()) / 10 ** 9
+
+        # Try to open the file
+        if task_path is not None and os.path.isfile(task_path):
+            with open(task_path) as task_file:
+                # Add all the pids to the list 'tasks'
+                tasks = task_file.read().rstrip().split("\n")
+                if "" in tasks:
+                    tasks.remove(
+                        ""
+                    )  # In order to prevent a crash if it reads the task file but it's empty
+
+        # Get user and system times from the stat file in the cpuacct cgroup for the job
+        if os.path.isfile(stat_path):
+            with open(stat_path) as stat_file:
+                for line in stat_file:
+                    times.append(
+                        line.rstrip().split()[1]
+                    )  # Could change for a for i in range() and remove the append...
+
+        data["user_time"] = int(times[0])
+        data["system_time"] = int(times[1])
+        data["tasks"] = list(map(int, tasks))
+
+        if CGROUP_IO_MEMORY:
+            self.__read_io_memory(job, user, data)
+        return data
+
+    def __read_io_memory(self, job, user, data):
+        """Reads the RSS and I/O totals of the job from its memory and blkio cgroups. Unlike a sum over the processes
+        still running, they include what the processes that already exited did. Whatever can't be read is left out
+        of data and gets summed over the processes instead."""
+        memory_stat_path = MEMORY_DIR + user + "/" + job + "/memory.stat"
+        if os.path.isfile(memory_stat_path):
+            # memory.usage_in_bytes includes the page cache, the total_ values of memory.stat include the child cgroups (steps)
+            memory_stat = read_key_values(memory_stat_path)
+            data["rss"] = (memory_stat["total_rss"] + memory_stat["total_mapped_file"]) / 1048576  # In MB
+
+        # Slurm doesn't constrain blkio, so the job only has a blkio cgroup if something else creates it
+        blkio_path = BLKIO_DIR + user + "/" + job + "/blkio.throttle."
+        service_bytes = read_blkio_totals(blkio_path + "io_service_bytes_recursive")
+        serviced = read_blkio_totals(blkio_path + "io_serviced_recursive")
+        if service_bytes is not None and serviced is not None:
+            data["read_mb"] = service_bytes["Read"] / 1048576  # In MB
+            data["write_mb"] = service_bytes["Write"] / 1048576  # In MB
+            data["read_count"] = serviced["Read"]
+            data["write_count"] = serviced["Write"]
+
+    def read_gpus(self, handle):
+        """Returns the GPUs of the job from the devices cgroup, None if it can't tell"""
+        job, user, dirname = handle
+        return read_job_gpus(user, job)
+
+
+class CgroupV2:
+    """Slurm jobs in the cgroup v2 unified hierarchy, laid out as job_*/step_*/user/task_*. Every controller of a job
+    is in the same directory and gives totals for the whole job in one read, including its RSS and I/O."""
+
+    def __init__(self):
+        self.__root = CGROUP2_DIR.rstrip("/")
+        # job directory -> uid of the job's user, there is no uid level in the cgroup v2 hierarchy
+        self.__uids = {}
+
+    def __read_tasks(self, job_dir):
+        """Reads the tids of every task cgroup of a job, slurmstepd itself is in step_*/slurm so it isn't counted"""
+        tasks = []
+        for path, dirs, files in os.walk(job_dir):
+            for f in fnmatch.filter(dirs, REGEX):
+                try:
+                    with open(os.path.join(path, f, "cgroup.threads")) as threads_file:
+                        tasks.extend(int(tid) for tid in threads_file.read().split())
+                except FileNotFoundError:
+                    continue
+        return tasks
+
+    def __find_uid(self, job_dir):
+        """Finds the uid of a job's user from the first process of the job, None if it has no process yet"""
+        for tid in self.__read_tasks(job_dir):
+            try:
+                with open("%s/%s/status" % (PROCFS_PATH, tid)) as status_file:
+                    for line in status_file:
+                        if line.startswith("Uid:"):
+                            return line.split()[1]
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+        return None
 
-    # Semi-static paths which change depending on user and job. Control groups.
-    cpuset_path = CPUSET_DIR + user + "/" + job + "/cpuset.cpus"
-    usage_percpu_path = CPUACCT_DIR + user + "/" + job + "/cpuacct.usage_percpu"
-    usage_total_path = CPUACCT_DIR + user + "/" + job + "/cpuacct.usage"
-    stat_path = CPUACCT_DIR + user + "/" + job + "/cpuacct.stat"
-    task_path = dirname + "/tasks"
-
-    # Look for which CPUs got allocated to this job
-    if os.path.isfile(cpuset_path):
-        with open(cpuset_path) as cpuset_file:
-            data = cpuset_file.readline().rstrip().split(",")
-            for alloc in data:
-                if "-" in alloc:
-                    alloc = alloc.split("-")
-                    for i in range(int(alloc[0]), int(alloc[1]) + 1):
-                        cpus.append(i)
-                else:
-                    cpus.append(int(alloc))
-
-    # Keep the job -> cpus map up to date with what was found. Useful to remove terminated jobs from the pushgateway
-    job_cpus_map[jobid] = cpus
-
-    # Cross-reference the allocated CPUs with their individual usages in nanoseconds
-    if os.path.isfile(usage_percpu_path):
-        with open(usage_percpu_path) as cpuacct_file:
-            data = cpuacct_file.readline().rstrip().split(" ")
-            for cpu in cpus:
-                usage = (
-                    int(data[cpu]) / 10 ** 9
-                )  # Divide the usage by 10 ** 9 because it's in nanoseconds (to send them to Prometheus is seconds).
-                cuc.labels(instance=HOST, slurm_job=jobid, core=cpu).set(usage)
-
-    # Gets total cpu time spent for this job. Will be used to compare loads on each cpu to the total time spent (load balancing)
-    if os.path.isfile(usage_total_path):
-        with open(usage_total_path) as cpuacct_file:
-            usage = (
-                int(cpuacct_file.readline().rstrip()) / 10 ** 9
-            )  # Divide usage by 10**9 because it's in nanoseconds (to send them to Prometheus in seconds).
-            cut.labels(instance=HOST, slurm_job=jobid).set(usage)
-
-    # Try to open the file
-    if os.path.isfile(task_path):
-        with open(task_path) as task_file:
-            # Add all the pids to the list 'tasks'
-            tasks = task_file.read().rstrip().split("\n")
-            if "" in tasks:
-                tasks.remove(
-                    ""
-                )  # In order to prevent a crash if it reads the task file but it's empty
-
-    # Get user and system times from the stat file in the cpuacct cgroup for the job
-    if os.path.isfile(stat_path):
-        with open(stat_path) as stat_file:
-            for line in stat_file:
-                times.append(
-                    line.rstrip().split()[1]
-                )  # Could change for a for i in range() and remove the append...
-
-    # Put data in collectors
-    ut.labels(instance=HOST, slurm_job=jobid).set(times[0])
-    st.labels(instance=HOST, slurm_job=jobid).set(times[1])
-    sp.labels(instance=HOST, slurm_job=jobid).set(len(tasks))
-
-    # Get process-specific data with psutil if tasks list isn't empty
-    if tasks:
-        tasks = list(map(int, tasks))
-        get_proc_data(tasks, len(cpus), jobid)
+    def discover(self):
+        """Finds the jobs currently running, see CgroupV1.discover"""
+        try:
+            job_dirs = {os.path.join(self.__root, d) for d in fnmatch.filter(os.listdir(self.__root), "job_*")}
+        except FileNotFoundError:
+            job_dirs = set()
+        for job_dir in set(self.__uids) - job_dirs:
+            del self.__uids[job_dir]
+
+        jobs = []
+        for job_dir in job_dirs:
+            if self.__uids.get(job_dir) is None:
+                self.__uids[job_dir] = self.__find_uid(job_dir)
+            # Jobs without tasks yet are skipped, like with cgroup v1
+            if self.__uids[job_dir] is not None:
+                jobs.append((os.path.basename(job_dir).split("_")[1], self.__uids[job_dir], job_dir))
+        return jobs
+
+    def find_job(self, jobid, uid=None):
+        """Finds a job from the path of its cgroup, even if it has no process left, see CgroupV1.find_job. The uid isn't
+        needed with cgroup v2."""
+        job_dir = os.path.join(self.__root, "job_" + jobid)
+        if os.path.isdir(job_dir):
+            return job_dir
+        return None
+
+    def read_job(self, job_dir):
+        """Reads the data of a job from its cgroup, see CgroupV1.read_job. There is no per cpu usage with cgroup v2."""
+        data = {"cpu_time_core": {}}
+        with open(job_dir + "/cpuset.cpus.effective") as cpuset_file:
+            data["cpus"] = parse_cpu_list(cpuset_file.readline())
+
+        cpu_stat = read_key_values(job_dir + "/cpu.stat")
+        data["cpu_time_total"] = cpu_stat["usage_usec"] / 10 ** 6
+        # Same unit as cpuacct.stat (USER_HZ) for cgroup v1
+        data["user_time"] = cpu_stat["user_usec"] * CLK_TCK // 10 ** 6
+        data["system_time"] = cpu_stat["system_usec"] * CLK_TCK // 10 ** 6
+
+        memory_stat = read_key_values(job_dir + "/memory.stat")
+        data["rss"] = (memory_stat["anon"] + memory_stat["file_mapped"]) / 1048576  # In MB
+
+        # One line per device: "8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0". Without the io controller, the
+        # I/O is left out of data and gets summed over the processes instead, like with CgroupV1.
+        if os.path.isfile(job_dir + "/io.stat"):
+            io = collections.Counter()
+            with open(job_dir + "/io.stat") as io_file:
+                for line in io_file:
+                    for field in line.split()[1:]:
+                        key, value = field.split("=")
+                        io[key] += int(value)
+            data["read_mb"] = io["rbytes"] / 1048576  # In MB
+            data["write_mb"] = io["wbytes"] / 1048576  # In MB
+            data["read_count"] = io["rios"]
+            data["write_count"] = io["wios"]
+
+        data["tasks"] = self.__read_tasks(job_dir)
+        return data
+
+    def read_gpus(self, job_dir):
+        """The devices controller of cgroup v2 is an eBPF program which can't be read, the environment has to be used"""
+        return None
+
+
+def select_cgroup_backend():
+    """Returns the cgroup backend to use, cgroup v2 if the node runs the unified hierarchy unless CGROUP_VERSION says otherwise"""
+    if CGROUP_VERSION == "v2" or (CGROUP_VERSION == "auto" and os.path.isfile(CGROUP2_CONTROLLERS)):
+        print("[+] Using the cgroup v2 backend on " + CGROUP2_DIR + " [+]")
+        return CgroupV2()
+    print("[+] Using the cgroup v1 backend on " + CPUACCT_DIR + " [+]")
+    return CgroupV1()
+
+
+def save_state(path, snapshot):
+    """Writes a checkpoint of what the exporter keeps between iterations, so a restarted exporter carries on as if it
+    never stopped. The checkpoint is written next to the previous one and renamed over it, so it is never torn.
 
+    Parameters
+    ----------
+    path : string
+        path of the checkpoint
+    snapshot : dictionnary
+        snapshot of the iteration that just completed
+    """
+    # The fd tables are left out: they hold a path for every fd of every process, which would make the checkpoint
+    # several MB for jobs with many open files. They are only resolved again once, on the first iteration.
+    state = {
+        "version": STATE_VERSION,
+        "boot_time": read_boot_time(),
+        "cpu_times": proc_cpu_times_last,
+        "gpus": job_gpus_map,
+        "end_times": job_end_time_map,
+        "schedule": job_schedule,
+        "snapshot": snapshot,
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as state_file:
+        # marshal is a compact binary format which, unlike pickle, can't run code when loaded
+        marshal.dump(state, state_file)
+        state_file.flush()
+        os.fsync(state_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_state(path):
+    """Restores what the exporter kept between iterations from its checkpoint. Nothing is restored if the checkpoint
+    is from another boot (the pids are reused) or can't be read.
 
-def retrieve_and_expose(timer):
+    Parameters
+    ----------
+    path : string
+        path of the checkpoint
+
+    Returns
+    -------
+    dictionnary
+        snapshot of the last iteration before the checkpoint, empty if nothing was restored
     """
-    Loop that retrieves and exposes the scraped data
+    global proc_cpu_times_last, job_gpus_map, job_end_time_map, job_schedule
+    try:
+        with open(path, "rb") as state_file:
+            state = marshal.load(state_file)
+    except FileNotFoundError:
+        return {}
+    except (EOFError, ValueError, TypeError) as e:
+        print("[-] Could not read the checkpoint " + path + ", starting from scratch: " + str(e) + " [-]")
+        return {}
+    if not isinstance(state, dict) or state.get("version") != STATE_VERSION:
+        print("[-] The checkpoint " + path + " is from another version, starting from scratch [-]")
+        return {}
+    if state["boot_time"] != read_boot_time():
+        print("[+] The checkpoint " + path + " is from another boot, starting from scratch [+]")
+        return {}
+    proc_cpu_times_last = state["cpu_times"]
+    job_gpus_map = state["gpus"]
+    job_end_time_map = state["end_times"]
+    job_schedule = state["schedule"]
+    return state["snapshot"]
+
+
+def run_iteration(backend, timer, last_snapshot, pool=None):
+    """
+    Retrieves the data of every job once and exposes it in the collector
 
     Parameters
     ----------
+    backend : CgroupV1 or CgroupV2
+        cgroup backend finding the jobs
     timer : integer
-        number of seconds to wait before next loop iteration
+        number of seconds between two iterations
+    last_snapshot : dictionnary
+        snapshot of the previous iteration, the jobs that aren't due keep their data from it
+    pool : ThreadPoolExecutor
+        workers retrieving the jobs' data in parallel, None to retrieve them one after the other
+
+    Returns
+    -------
+    dictionnary
+        snapshot of this iteration, jobid -> data of the job
     """
-    # Prevents from sending delete to the pushgateway if no job was pushed two times in a row (i.e. all the jobs are done and accounted for for now)
-    iter_empty = 0
-    last_iter_found = []
-    while True:
-        # List for found jobs
-        found = []
-        empty = True
+    global proc_cpu_times_last, proc_cpu_times_current, proc_fd_tables_last, proc_fd_tables_current
+    # jobid -> data of the job, swapped in the collector once every job was retrieved
+    snapshot = {}
+    # Jobs that aren't due on this iteration, they keep the data of their last sample
+    skipped = []
+    # Arguments to give to retrieve_file_data for each found job
+    to_retrieve = []
+    # What retrieving the jobs cost, summed over every job of this iteration
+    costs = collections.Counter()
+    # Same wall clock / uptime for every process in this iteration
+    now = time.monotonic()
+    uptime = read_uptime()
+
+    for jobid, uid, handle in backend.discover():
+        # Skips blacklist users.
+        if uid in BLACKLIST:
+            continue
+        if ADAPTIVE_MAX_INTERVAL is not None and jobid in last_snapshot and not is_due(jobid, now):
+            snapshot[jobid] = last_snapshot[jobid]
+            skipped.append(jobid)
+        else:
+            to_retrieve.append((backend, jobid, handle, now, uptime))
+    phase_time.labels(instance=HOST, phase="discovery").observe(time.monotonic() - now)
 
-        # These `for loops` count the number of spawned processes by a task.
-        for path, dirs, files in os.walk(CPUACCT_DIR):
-            # Look for the REGEX (global constant, change this for other schedulers perhaps...), default is "task_*"
-            for f in fnmatch.filter(dirs, REGEX):
-                empty = False
-                # Find full name of the path
-                fullname = os.path.abspath(os.path.join(path, f))
-                # Find the job ID
-                job = re.search("(job_)[0-9]+", fullname).group(
-                    0
-                )  # Used for file names
-                # Used to push metrics at the right job
-                jobid = job.split("_")[1]
-                user = re.search("(uid_)[0-9]+", fullname).group(
-                    0
-                )  # Used for file names
-                uid = user.split("_")[1]
-
-                # Avoid finding the same job twice in the same iteration and skips blacklist users.
-                if jobid not in found and uid not in BLACKLIST:
-                    found.append(jobid)
-                    retrieve_file_data(job, jobid, user, fullname)
-
-        if empty:
-            iter_empty += 1
+    # Retrieve every job (in parallel if asked to) and build the snapshot of this iteration
+    if pool:
+        results = pool.map(lambda args: retrieve_file_data(*args), to_retrieve)
+    else:
+        results = (retrieve_file_data(*args) for args in to_retrieve)
+    for jobid, data in results:
+        if data is None:
+            continue
+        costs.update(data.pop("costs"))
+        add_to_snapshot(snapshot, jobid, data)
+        if ADAPTIVE_MAX_INTERVAL is not None:
+            reschedule(jobid, last_snapshot.get(jobid), data, now, timer)
+
+    # The processes of the skipped jobs weren't read, keep what is known about them for their next sample
+    for jobid in skipped:
+        for pid in snapshot[jobid].get("pids", ()):
+            if pid in proc_cpu_times_last:
+                proc_cpu_times_current[pid] = proc_cpu_times_last[pid]
+            if pid in proc_fd_tables_last:
+                proc_fd_tables_current[pid] = proc_fd_tables_last[pid]
+
+    # Only keep the cpu times of the processes seen in this iteration, terminated processes are dropped
+    proc_cpu_times_last = proc_cpu_times_current
+    proc_cpu_times_current = {}
+    proc_fd_tables_last = proc_fd_tables_current
+    proc_fd_tables_current = {}
+
+    # Expose the whole iteration at once, the jobs that are done vanish from it with no delete needed
+    JOBS.swap(snapshot)
+    for jobid in set(last_snapshot) - set(snapshot):
+        forget_inactive_job(jobid)
+
+    phase_time.labels(instance=HOST, phase="cgroup_read").observe(costs["cgroup_seconds"])
+    phase_time.labels(instance=HOST, phase="proc_read").observe(costs["proc_seconds"])
+    phase_time.labels(instance=HOST, phase="fd_scan").observe(costs["fd_seconds"])
+    pids_visited.labels(instance=HOST).inc(costs["pids"])
+    fds_visited.labels(instance=HOST).inc(costs["fds"])
+    vanished_processes.labels(instance=HOST).inc(costs["vanished"])
+    elapsed = time.monotonic() - now
+    iteration_time.labels(instance=HOST).set(elapsed)
+    if elapsed > timer:
+        cycle_overruns.labels(instance=HOST).inc()
+
+    return snapshot
+
+
+# (jobid, threading.Event set once served, result) of the flush requests, served by the main thread between iterations
+flush_requests = queue.Queue()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Serves one request on the control socket. The only request is "flush <jobid> [<uid>]", answered with
+    "ok <jobid>" once the final sample of the job was collected and pushed, or "gone <jobid>" if the job has no cgroup
+    anymore. The uid of the job's user lets the exporter find the cgroup of the job from its path."""
+
+    def handle(self):
+        self.connection.settimeout(CONTROL_TIMEOUT)
+        request = self.rfile.readline(64).decode(errors="replace").split()
+        if len(request) not in (2, 3) or request[0] != "flush" or not all(arg.isdigit() for arg in request[1:]):
+            self.wfile.write(b"error expected: flush <jobid> [<uid>]\n")
+            return
+        uid = request[2] if len(request) == 3 else None
+        # The main thread owns the caches and the snapshot, it does the collection while it waits for the next iteration
+        done = threading.Event()
+        result = {}
+        flush_requests.put((request[1], uid, done, result))
+        if done.wait(CONTROL_TIMEOUT):
+            self.wfile.write(("%s %s\n" % (result["status"], request[1])).encode())
         else:
-            iter_empty = 0
+            self.wfile.write(("timeout %s\n" % request[1]).encode())
+
+
+def start_control_server(path):
+    """Listens on the control socket in a background thread, only root can connect to it"""
+    if os.path.exists(path):
+        # Left behind by a previous run
+        os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, ControlHandler)
+    server.daemon_threads = True
+    os.chmod(path, 0o600)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def request_flush(path, jobid, uid=None):
+    """Asks the exporter listening on the control socket for the final sample of a job, used from the epilog. The uid
+    of the job's user is needed to find the cgroup of a job with cgroup v1 when it has no task left.
+
+    Returns
+    -------
+    boolean
+        True if the final sample was collected and pushed
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(CONTROL_TIMEOUT)
+    try:
+        client.connect(path)
+        client.sendall(("flush %s\n" % " ".join(str(arg) for arg in (jobid, uid) if arg is not None)).encode())
+        answer = client.makefile().readline().strip()
+    except OSError as e:
+        print("[-] Could not reach the exporter on " + path + ": " + str(e) + " [-]")
+        return False
+    finally:
+        client.close()
+    print("[+] " + answer + " [+]")
+    return answer.startswith("ok ")
+
+
+def flush_jobs(backend, snapshot, requests):
+    """Collects the final sample of the jobs asked for by the epilog, out of the regular iterations, and pushes them
+
+    Parameters
+    ----------
+    backend : CgroupV1 or CgroupV2
+        cgroup backend finding the jobs
+    snapshot : dictionnary
+        snapshot of the last iteration
+    requests : list
+        (jobid, uid or None, threading.Event, result) of the flush requests
+
+    Returns
+    -------
+    dictionnary
+        the snapshot with the final samples of the jobs
+    """
+    snapshot = dict(snapshot)
+    now = time.monotonic()
+    uptime = read_uptime()
+    flushed = False
+    for jobid, uid, done, result in requests:
+        # Found from the path of its cgroup: when the epilog runs, the processes of the job are gone and its task
+        # cgroups may be too, the job cgroup still holds its totals
+        handle = backend.find_job(jobid, uid) if uid not in BLACKLIST else None
+        if handle is None:
+            result["status"] = "gone"
+            continue
+        jobid, data = retrieve_file_data(backend, jobid, handle, now, uptime)
+        if data is None:
+            result["status"] = "gone"
+            continue
+        data.pop("costs")
+        # The processes may already be gone, what was only known from them is kept from the last sample
+        final = dict(snapshot.get(jobid, {}))
+        final.update(data)
+        add_to_snapshot(snapshot, jobid, final)
+        result["status"] = "ok"
+        flushed = True
+    if flushed:
+        JOBS.swap(snapshot)
+        if PULL_PORT is None:
+            push_data()
+    for jobid, uid, done, result in requests:
+        done.set()
+    return snapshot
+
+
+def wait_next_iteration(backend, timer, snapshot):
+    """Waits for the next iteration, serving the flush requests of the epilog meanwhile
+
+    Returns
+    -------
+    dictionnary
+        the snapshot, with the final samples of the flushed jobs
+    """
+    if CONTROL_SOCKET is None:
+        time.sleep(timer)
+        return snapshot
+    deadline = time.monotonic() + timer
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return snapshot
+        try:
+            requests = [flush_requests.get(timeout=remaining)]
+        except queue.Empty:
+            return snapshot
+        # Epilogs of jobs ending together are served with a single push
+        while not flush_requests.empty():
+            requests.append(flush_requests.get())
+        snapshot = flush_jobs(backend, snapshot, requests)
 
-        # Find the list of newly terminated jobs
-        diff = list(set(last_iter_found) - set(found))
-        for jobid in diff:
-            remove_inactive_jobs_from_collectors(jobid)
 
-        if not empty:
-            # Send data to the pushgateway
-            push_to_gateway("localhost:9091",
-                            job="jobs_exporter", registry=REGISTRY)
+def retrieve_and_expose(timer, workers=1):
+    """
+    Loop that retrieves and exposes the scraped data
 
-        # Wait the set amount of time before re-retrieving and exposing the next set of data.
-        time.sleep(timer)
+    Parameters
+    ----------
+    timer : integer
+        number of seconds to wait before next loop iteration
+    workers : integer
+        number of threads used to retrieve the jobs' data in parallel, 1 retrieves them one after the other
+    """
+    # Threads are enough since most of the time is spent in system calls reading cgroups and /proc, and they share the cpu times mapping
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    backend = select_cgroup_backend()
+    # Expose the counters from the start, even the ones which may never be incremented
+    for counter in (pids_visited, fds_visited, vanished_processes, cycle_overruns, push_failures):
+        counter.labels(instance=HOST)
+    snapshot = {}
+    if STATE_PATH is not None:
+        # The jobs of the checkpoint that ended while the exporter was down are forgotten on the first iteration
+        snapshot = load_state(STATE_PATH)
+        print("[+] Restored the state of " + str(len(snapshot)) + " job(s) from " + STATE_PATH + " [+]")
+    while True:
+        snapshot = run_iteration(backend, timer, snapshot, pool)
+        if STATE_PATH is not None:
+            save_state(STATE_PATH, snapshot)
 
-        # Delete from Pushgateway, else it creates flat lines for jobs that don't exist anymore.
-        if iter_empty <= 1:
-            delete_from_gateway("localhost:9091", job="jobs_exporter")
+        if PULL_PORT is None:
+            push_data()
 
-        last_iter_found = found.copy()
+        # Wait the set amount of time before re-retrieving and exposing the next set of data.
+        snapshot = wait_next_iteration(backend, timer, snapshot)
 
 
 if __name__ == "__main__":
@@ -504,7 +1792,110 @@ if __name__ == "__main__":
         help="Set the path (fully qualified name) of the blacklist to load, by default, no blacklist is loaded",
         type=str,
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Set the number of threads retrieving the jobs' data in parallel, by default it is set to 1 (no parallelism)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-f",
+        "--max-fds",
+        help="Set the maximum number of file descriptors scanned per job on each iteration, by default every file descriptor is scanned",
+        type=int,
+    )
+    parser.add_argument(
+        "-p",
+        "--pull",
+        help="Serve the metrics on /metrics on this port for Prometheus to scrape, by default the metrics are pushed to the pushgateway on " + PUSHGATEWAY,
+        type=int,
+    )
+    parser.add_argument(
+        "--cgroup-io-memory",
+        help="Read the RSS and I/O of the jobs from their memory and blkio cgroups instead of summing them over the processes (always done with cgroup v2)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-c",
+        "--cgroup",
+        help="Set the cgroup version of the node (v1 or v2), by default it is detected",
+        choices=["auto", "v1", "v2"],
+        default="auto",
+    )
+    parser.add_argument(
+        "-s",
+        "--spool",
+        help="Set the path of the spool keeping the samples while the pushgateway can't be reached, they are replayed into OpenMetrics files next to it for backfilling. By default the samples are dropped",
+        type=str,
+    )
+    parser.add_argument(
+        "--spool-max-mb",
+        help="Set the maximum size of the spool in MB, the oldest samples are dropped past it, by default it is set to 64MB",
+        type=int,
+    )
+    parser.add_argument(
+        "--state",
+        help="Set the path of the checkpoint of the exporter's state, written every iteration and reloaded on startup, by default nothing is kept across restarts",
+        type=str,
+    )
+    parser.add_argument(
+        "--control-socket",
+        help="Set the path of the unix socket on which the epilog asks for the final sample of a job, by default no socket is opened",
+        type=str,
+    )
+    parser.add_argument(
+        "--flush",
+        help="Ask the exporter listening on --control-socket for the final sample of this job and exit, used in the epilog",
+        type=str,
+    )
+    parser.add_argument(
+        "--uid",
+        help="uid of the user of the job given to --flush ($SLURM_JOB_UID), to find its cgroup once its processes exited",
+        type=str,
+    )
+    parser.add_argument(
+        "-a",
+        "--adaptive-max",
+        help="Back off the sampling of the jobs whose metrics are stable, up to this interval in seconds (the timer being the shortest), by default every job is sampled on every iteration",
+        type=int,
+    )
     args = parser.parse_args()
+    if args.flush:
+        if not args.control_socket:
+            parser.error("--flush requires --control-socket")
+        # The client pushes nothing, interrupting it must not delete the metrics the daemon pushed
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        sys.exit(0 if request_flush(args.control_socket, args.flush, args.uid) else 1)
+    CGROUP_VERSION = args.cgroup
+    CGROUP_IO_MEMORY = args.cgroup_io_memory
+
+    if args.pull:
+        PULL_PORT = args.pull
+        start_http_server(PULL_PORT, registry=REGISTRY)
+        print("[+] Serving the metrics on port " + str(PULL_PORT) + " [+]")
+
+    if args.max_fds:
+        FD_SCAN_LIMIT = args.max_fds
+        print("[+] Scanning at most " + str(FD_SCAN_LIMIT) + " file descriptors per job [+]")
+
+    if args.spool and not args.pull:
+        if args.spool_max_mb:
+            SPOOL_MAX_BYTES = args.spool_max_mb * 1048576
+        SPOOL = MetricSpool(args.spool, SPOOL_MAX_BYTES)
+        print("[+] Spooling the samples to " + args.spool + " while the pushgateway can't be reached [+]")
+
+    if args.state:
+        STATE_PATH = args.state
+
+    if args.control_socket:
+        CONTROL_SOCKET = args.control_socket
+        start_control_server(CONTROL_SOCKET)
+        print("[+] Listening for the final samples of the jobs on " + CONTROL_SOCKET + " [+]")
+
+    if args.adaptive_max:
+        ADAPTIVE_MAX_INTERVAL = max(args.adaptive_max, args.timer or 15)
+        print("[+] Sampling the stable jobs at most every " + str(ADAPTIVE_MAX_INTERVAL) + "s [+]")
 
     # Load blacklist
     if args.blacklist:
@@ -517,21 +1908,22 @@ if __name__ == "__main__":
     if args.timer:
         print(
             "[+] Started the exporter with an interval of " +
-            str(args.timer) + "s [+]"
+            str(args.timer) + "s and " + str(args.workers) + " worker(s) [+]"
         )
         try:
-            retrieve_and_expose(args.timer)
+            retrieve_and_expose(args.timer, args.workers)
         except Exception as e:
             print("[-] Program crashed, printing caught exception... [-]")
             print(str(e))
         finally:
-            delete_from_gateway("localhost:9091", job="jobs_exporter")
+            delete_pushed_data()
     else:
-        print("[+] Started the exporter with an interval of 15s [+]")
+        print("[+] Started the exporter with an interval of 15s and " +
+              str(args.workers) + " worker(s) [+]")
         try:
-            retrieve_and_expose(15)
+            retrieve_and_expose(15, args.workers)
         except Exception as e:
             print("[-] Program crashed, printing caught exception... [-]")
             print(str(e))
         finally:
-            delete_from_gateway("localhost:9091", job="jobs_exporter")
+            delete_pushed_data()
@@ -11,6 +11,8 @@ domain=${ADDR[2]} #Find the specific domain name (i.e. kappa from mgmt01.int.kap
 
 loginhost="login1.int.${domain}.calculquebec.cloud"
 
-commands="CREATE USER '${newUser}'@'${loginhost}' IDENTIFIED BY '${newDbPassword}';USE slurm_acct_db; CREATE VIEW user_job_view AS SELECT id_user, id_job, job_name FROM ${domain}_job_table; GRANT SELECT ON user_job_view TO '${newUser}'@'${loginhost}'; FLUSH PRIVILEGES;"
+# user_job_view also exposes the accounting metadata read by the web app (webapp/accounting.py) and tres_view the names
+# of the TRES ids of tres_alloc. Running the script again extends the views of an existing installation.
+commands="CREATE USER IF NOT EXISTS '${newUser}'@'${loginhost}' IDENTIFIED BY '${newDbPassword}';USE slurm_acct_db; CREATE OR REPLACE VIEW user_job_view AS SELECT id_user, id_job, job_name, account, time_start, time_end, tres_alloc, nodelist FROM ${domain}_job_table; CREATE OR REPLACE VIEW tres_view AS SELECT id, type, name FROM tres_table; GRANT SELECT ON user_job_view TO '${newUser}'@'${loginhost}'; GRANT SELECT ON tres_view TO '${newUser}'@'${loginhost}'; FLUSH PRIVILEGES;"
 
 echo "${commands}" | /usr/bin/mysql
@@ -0,0 +1,264 @@
+import subprocess
+import threading
+import datetime
+from pwd import getpwuid
+import pymysql
+import external_access
+import user
+
+SACCT = "/opt/software/slurm/bin/sacct"
+FORMAT = "--format=JobIDRaw,Account,User,Start,End,AllocCPUs,AllocTres,NodeList,Elapsed"
+# Restricted views of slurm_acct_db petricore can read (see mgmt/create_user_job_view.sh)
+JOB_COLUMNS = "SELECT id_job, account, id_user, time_start, time_end, tres_alloc, nodelist FROM user_job_view "
+# A requeued job has several rows, the last one (ordered by time_start) wins
+JOBS_QUERY = JOB_COLUMNS + "WHERE id_job IN ({}) ORDER BY time_start"
+USER_JOBS_QUERY = (
+    "SELECT * FROM (" + JOB_COLUMNS + "WHERE id_user = %s AND time_end > 0 ORDER BY time_end DESC LIMIT %s) AS last_jobs "
+    "ORDER BY time_start"
+)
+# Paged on (time_end, id_job), so the jobs which ended in the same second are never skipped
+FINISHED_JOBS_QUERY = (
+    JOB_COLUMNS + "WHERE (time_end > %s OR (time_end = %s AND id_job > %s)) AND time_end <= %s "
+    "ORDER BY time_end, id_job LIMIT %s"
+)
+TRES_QUERY = "SELECT id, type, name FROM tres_view"
+
+
+class JobNotFound(Exception):
+    pass
+
+
+class JobNotFinished(Exception):
+    pass
+
+
+def format_elapsed(seconds):
+    """Formats a duration like sacct's Elapsed field ([D-]HH:MM:SS)"""
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    elapsed = "%02d:%02d:%02d" % (hours, minutes, seconds)
+    if days:
+        elapsed = str(days) + "-" + elapsed
+    return elapsed
+
+
+def parse_sacct_time(timestamp):
+    """
+    Converts a Start/End field of sacct (local time, i.e. 2020-05-01T10:00:00) to epoch
+
+    Raises
+    ------
+    JobNotFinished
+        if the field isn't a time (Unknown, None) because the job didn't start or end yet
+    """
+    try:
+        return int(datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S").timestamp())
+    except ValueError:
+        raise JobNotFinished(timestamp)
+
+
+class Accounting:
+    """
+    Reads the metadata of finished jobs directly from Slurm's accounting database, through the restricted views of
+    petricore, with no process spawned. sacct is used when the database can't be reached or doesn't have the job.
+    """
+
+    def __init__(self):
+        # Flask serves the requests from several threads, each one gets its own connection
+        self.__local = threading.local()
+        # tres id -> name as sacct shows it (cpu, mem, gres/gpu, ...)
+        self.__tres_names = None
+
+    def __connection(self):
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = self.__local.connection = external_access.create_slurm_db_connection(
+                user.SLURM_DB_HOST, user.SLURM_DB_PORT, user.SLURM_DB_USER, user.SLURM_DB_PASS, user.SLURM_ACCT_DB
+            )
+        else:
+            connection.ping(reconnect=True)
+        return connection
+
+    def __format_tres(self, cursor, tres_alloc):
+        """Converts tres_alloc (i.e. 1=4,2=4000,4=1,5=4) to sacct's AllocTRES (billing=4,cpu=4,mem=4000M,node=1)"""
+        if self.__tres_names is None:
+            cursor.execute(TRES_QUERY)
+            self.__tres_names = {
+                str(tres_id): tres_type + ("/" + name if name else "") for tres_id, tres_type, name in cursor.fetchall()
+            }
+        tres = {}
+        for item in tres_alloc.split(","):
+            if "=" not in item:
+                continue
+            tres_id, count = item.split("=", 1)
+            name = self.__tres_names.get(tres_id)
+            if name is not None:
+                # Memory in MB like sacct --units=M
+                tres[name] = count + "M" if name == "mem" else count
+        return ",".join(name + "=" + tres[name] for name in sorted(tres))
+
+    def __to_metadata(self, cursor, row):
+        """Converts a row of user_job_view to the metadata of the job, None if the job didn't end"""
+        jobid, account, id_user, time_start, time_end, tres_alloc, nodelist = row
+        if not time_start or not time_end:
+            return None
+        alloc_tres = self.__format_tres(cursor, tres_alloc or "")
+        alloc_cpu = 0
+        for tres in alloc_tres.split(","):
+            if tres.startswith("cpu="):
+                alloc_cpu = int(tres.split("=")[1])
+        try:
+            username = getpwuid(id_user).pw_name
+        except KeyError:
+            username = str(id_user)
+        return {
+            "account": account,
+            "user": username,
+            "start": time_start,
+            "end": time_end,
+            "alloc_cpu": alloc_cpu,
+            "alloc_tres": alloc_tres,
+            "nodes": nodelist,
+            "elapsed": format_elapsed(time_end - time_start),
+        }
+
+    def __query_database(self, query, args):
+        """Returns the metadata of the jobs matched by a query on user_job_view, by job ID"""
+        jobs = {}
+        with self.__connection().cursor() as cursor:
+            cursor.execute(query, args)
+            for row in cursor.fetchall():
+                jobs[str(row[0])] = self.__to_metadata(cursor, row)
+        return jobs
+
+    def __query_sacct(self, jobids):
+        """Returns the metadata of the jobs, by job ID, from a single call to sacct"""
+        out = subprocess.check_output(
+            [SACCT, "--units=M", "-X", "-n", "-p", FORMAT, "-j", ",".join(str(jobid) for jobid in jobids)]
+        )
+        jobs = {}
+        for line in out.decode("ascii").split("\n"):
+            if not line:
+                continue
+            out = line.split("|")
+            try:
+                jobs[out[0]] = {
+                    "account": out[1],
+                    "user": out[2],
+                    "start": parse_sacct_time(out[3]),
+                    "end": parse_sacct_time(out[4]),
+                    "alloc_cpu": int(out[5]),
+                    "alloc_tres": out[6],
+                    "nodes": out[7],
+                    "elapsed": out[8],
+                }
+            except JobNotFinished:
+                jobs[out[0]] = None
+        return jobs
+
+    def get_jobs(self, jobids):
+        """
+        Retrieves the accounting metadata of many jobs at once: one query on the database, then one call to sacct for
+        the jobs it doesn't have
+
+        Parameters
+        ----------
+        jobids : list
+            Slurm jobs' IDs
+
+        Returns
+        -------
+        dictionnary
+            job ID (string) -> metadata of the job (see get_job), None if the job didn't end. The jobs which don't exist
+            are left out.
+        """
+        jobids = sorted(set(int(jobid) for jobid in jobids))
+        if not jobids:
+            return {}
+        try:
+            jobs = self.__query_database(JOBS_QUERY.format(", ".join(["%s"] * len(jobids))), jobids)
+        except pymysql.MySQLError as e:
+            # i.e. the views weren't extended yet (mgmt/create_user_job_view.sh)
+            print("[-] Could not read the jobs from the accounting database: " + str(e) + " [-]", flush=True)
+            jobs = {}
+        missing = [jobid for jobid in jobids if str(jobid) not in jobs]
+        if missing:
+            jobs.update(self.__query_sacct(missing))
+        return jobs
+
+    def get_user_jobs(self, uid, limit):
+        """
+        Retrieves the accounting metadata of the last finished jobs of a user, with one query on the database
+
+        Parameters
+        ----------
+        uid : integer
+            user's ID
+        limit : integer
+            maximum number of jobs, the ones which ended last are kept
+
+        Returns
+        -------
+        dictionnary
+            job ID (string) -> metadata of the job (see get_job)
+        """
+        return self.__query_database(USER_JOBS_QUERY, (uid, limit))
+
+    def get_finished_jobs(self, after, until, limit):
+        """
+        Retrieves the accounting metadata of the jobs of every user which ended in a time range, with one query on the
+        database, one page at a time
+
+        Parameters
+        ----------
+        after : tuple
+            (end as epoch, job ID) of the last job of the previous page, excluded, i.e. (since, 0) for the first page
+        until : integer
+            epoch, included
+        limit : integer
+            maximum number of rows, the ones which ended first are kept
+
+        Returns
+        -------
+        tuple
+            job ID (string) -> metadata of the job (see get_job), None if the job didn't start; and the (end, job ID)
+            of the last row to pass as after for the next page, None if the page is the last one
+        """
+        end, jobid = after
+        with self.__connection().cursor() as cursor:
+            cursor.execute(FINISHED_JOBS_QUERY, (end, end, jobid, until, limit))
+            rows = cursor.fetchall()
+            jobs = {str(row[0]): self.__to_metadata(cursor, row) for row in rows}
+        if len(rows) < limit:
+            return jobs, None
+        # Cancelled jobs included, so a page of them doesn't stop the paging
+        return jobs, (rows[-1][4], rows[-1][0])
+
+    def get_job(self, jobid):
+        """
+        Retrieves the accounting metadata of a finished job
+
+        Parameters
+        ----------
+        jobid : integer
+            Slurm job's ID
+
+        Returns
+        -------
+        dictionnary
+            account, user, start and end (epoch), alloc_cpu, alloc_tres, nodes and elapsed of the job
+
+        Raises
+        ------
+        JobNotFound
+            if the job doesn't exist
+        JobNotFinished
+            if the job didn't end yet
+        """
+        jobs = self.get_jobs([jobid])
+        if str(jobid) not in jobs:
+            raise JobNotFound(jobid)
+        if jobs[str(jobid)] is None:
+            raise JobNotFinished(jobid)
+        return jobs[str(jobid)]
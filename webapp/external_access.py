@@ -1,5 +1,8 @@
 import pymysql.cursors
 import ldap
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 def get_domain_name():
@@ -71,3 +74,86 @@ def create_ldap_connection(host):
     connection.set_option(ldap.OPT_REFERRALS, 0)
     connection.simple_bind_s()
     return connection
+
+
+class PrometheusClient:
+    """
+    Client of the Prometheus HTTP API sharing a pool of keep-alive connections between every query (and thread),
+    with timeouts, retries with exponential backoff on connection errors and unavailable responses, and gzip
+    compressed responses
+    """
+
+    def __init__(self, host, pool_size=16, timeout=(3.05, 60), retries=3, backoff_factor=0.5):
+        """
+        Parameters
+        ----------
+        host : string
+            URL of Prometheus (http://host:port)
+        pool_size : integer
+            maximum number of connections kept open to Prometheus, as many as threads querying it at once
+        timeout : tuple
+            (connect, read) timeouts in seconds of a query
+        retries : integer
+            number of times a failed query is retried, waiting backoff_factor * 2 ** retry seconds in between
+        backoff_factor : float
+            base of the waits between retries in seconds
+        """
+        self.__host = host
+        self.__timeout = timeout
+        # The queries only read, so retrying a POST is as safe as retrying a GET
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=("GET", "POST"),
+        )
+        self.__session = requests.Session()
+        self.__session.mount(host, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+        # Decompressed by requests, the results of range queries compress very well
+        self.__session.headers["Accept-Encoding"] = "gzip"
+
+    def __request(self, endpoint, params):
+        # POST since the merged queries can be too long for a URL
+        response = self.__session.post(self.__host + endpoint, data=params, timeout=self.__timeout)
+        response.raise_for_status()
+        return response.json()["data"]["result"]
+
+    def query(self, query, time):
+        """
+        Evaluates an instant query
+
+        Parameters
+        ----------
+        query : string
+            PromQL query
+        time : integer
+            evaluation time (epoch)
+
+        Returns
+        -------
+        list
+            series of the result with their "metric" and "value"
+        """
+        return self.__request("/api/v1/query", {"query": query, "time": time})
+
+    def query_range(self, query, start, end, step):
+        """
+        Evaluates a range query
+
+        Parameters
+        ----------
+        query : string
+            PromQL query
+        start : integer
+            start of the range (epoch)
+        end : integer
+            end of the range (epoch)
+        step : string
+            resolution of the range (i.e. 15s)
+
+        Returns
+        -------
+        list
+            series of the result with their "metric" and "values"
+        """
+        return self.__request("/api/v1/query_range", {"query": query, "start": start, "end": end, "step": step})
@@ -1,22 +1,21 @@
-import subprocess
 import datetime
-import requests
 import json
 import os
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from pylatex import Document, Section, Figure, NoEscape, NewPage, Command
 from user import User
 from socket import gethostname
 import external_access
+from accounting import Accounting
+from summary_store import SummaryStore
 
 CWD = "/var/www/logic_webapp/"
 PROM_HOST = "http://mgmt1.int." + external_access.get_domain_name() + ":9090"
-API_URL = PROM_HOST + "/api/v1/query"
 # charlie, sigma, ... [name].calculquebec.cloud
 LOCALHOST = gethostname().split(".")[0]
 # LOCALHOST = LOCALHOST.split(".")[0]
-SACCT = "/opt/software/slurm/bin/sacct"
-FORMAT = "--format=Account,User,Start,End,AllocCPUs,AllocTres,NodeList,Elapsed"
 STEP_SIZE = '15s'
 Y_LABELS = {
     "jobs_rss": "Resident set size (MB)",
@@ -27,6 +26,322 @@ Y_LABELS = {
     "jobs_system_time": "Time in system mode",
     "jobs_cpu_time_core": "CPU Time",
 }
+# Number of Prometheus queries of a job running at the same time
+QUERY_WORKERS = 16
+# Shared by every Job, so the queries reuse the connections to Prometheus instead of opening one each
+PROMETHEUS = external_access.PrometheusClient(PROM_HOST, pool_size=QUERY_WORKERS)
+QUERY_POOL = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+# Metadata of the jobs, read from slurm_acct_db without spawning sacct
+ACCOUNTING = Accounting()
+# Maximum number of jobs whose series are selected by one query of summarize_jobs
+QUERY_BATCH_JOBS = 100
+# Summaries of the finished jobs, computed once by the rollup stage of the web app (see logic_webapp.rollup_loop)
+SUMMARY_STORE = SummaryStore(CWD + "summaries.sqlite")
+# Data of a job loaded from Prometheus, by facet: (metrics read at the end of the job, (modifier, metric) of the
+# rollups over its length). The GPU facet needs a second query once the GPUs of the job are known.
+PROMETHEUS_FACETS = {
+    # CPU and memory usage
+    "cpu": (
+        ("jobs_cpu_time_core", "jobs_cpu_time_total"),
+        (("avg", "jobs_cpu_percent"), ("max", "jobs_cpu_percent"), ("max", "jobs_rss")),
+    ),
+    "io": (
+        ("jobs_uses_scratch", "jobs_read_mb", "jobs_write_mb", "jobs_read_count", "jobs_write_count"),
+        (("avg", "jobs_opened_files"),),
+    ),
+    # Threads counts (i.e. How many threads did you spawn ?)
+    "threads": ((), (("max", "jobs_thread_count"),)),
+    "gpu": (("jobs_gpus_used",), ()),
+}
+# Rollups over the length of a job of the GPUs it used, queried once its GPUs are known
+GPU_ROLLUPS = [
+    (modifier, metric)
+    for metric in ['utilization_gpu', 'utilization_memory', 'temperature_gpu', 'memory_total', 'memory_free',
+                   'memory_used']
+    for modifier in ['max', 'avg', 'min']
+]
+
+
+def query_all(queries, time):
+    """
+    Runs instant queries concurrently on the Prometheus HTTP API
+
+    Parameters
+    ----------
+    queries : list
+        PromQL queries
+    time : integer
+        evaluation time of the queries (epoch)
+
+    Returns
+    -------
+    list
+        result of each query (list of series with their "metric" and "value"), in the same order
+    """
+    futures = [QUERY_POOL.submit(PROMETHEUS.query, query_string, time) for query_string in queries]
+    return [future.result() for future in futures]
+
+
+def rollup_expression(modifier, metric, selector, step):
+    """
+    Returns the PromQL expression of modifier_over_time on a metric over the length of a job. The *_over_time functions
+    drop the metric name, so the expression gets a "rollup" label (i.e. rollup="max_jobs_rss") to tell its series apart.
+
+    Parameters
+    ----------
+    modifier : string
+        max, avg, min, ...
+    metric : string
+        name of the metric
+    selector : string
+        label matchers of the series (i.e. {slurm_job="42"})
+    step : integer
+        length of the job in seconds
+    """
+    return (
+        "label_replace("
+        + modifier
+        + "_over_time("
+        + metric
+        + selector
+        + "["
+        + str(step)
+        + 's]), "rollup", "'
+        + modifier
+        + "_"
+        + metric
+        + '", "", "")'
+    )
+
+
+def plan_queries(selector, step, metrics=(), rollups=()):
+    """
+    Merges the queries of a job into as few PromQL queries as possible: one selector matching every metric read as is,
+    and the union (or) of every rollup
+
+    Parameters
+    ----------
+    selector : string
+        label matchers shared by the series (i.e. slurm_job="42"), without braces
+    step : integer
+        length of the job in seconds, the range of the rollups
+    metrics : list
+        names of the metrics read as they are
+    rollups : list
+        (modifier, metric) of the rollups over the length of the job
+
+    Returns
+    -------
+    list
+        PromQL queries, to be given to query_all and their results to demultiplex
+    """
+    queries = []
+    if metrics:
+        queries.append('{__name__=~"' + "|".join(metrics) + '",' + selector + "}")
+    if rollups:
+        queries.append(
+            " or ".join(rollup_expression(modifier, metric, "{" + selector + "}", step) for modifier, metric in rollups)
+        )
+    return queries
+
+
+def demultiplex(results):
+    """
+    Splits the results of merged queries by metric
+
+    Parameters
+    ----------
+    results : list
+        results of the queries, as returned by query_all
+
+    Returns
+    -------
+    dictionnary
+        metric name (or rollup name, i.e. max_jobs_rss) -> series of the metric, empty list for the metrics with no series
+    """
+    split = collections.defaultdict(list)
+    for result in results:
+        for item in result:
+            split[item["metric"].get("rollup", item["metric"].get("__name__"))].append(item)
+    return split
+
+
+def gpus_of(results):
+    """
+    Returns the GPUs used by a job
+
+    Parameters
+    ----------
+    results : list
+        series of jobs_gpus_used of the job
+
+    Returns
+    -------
+    dictionnary
+        node -> set of the IDs of the GPUs of the job on the node
+    """
+    alloc_gpu = {}
+    for item in results:
+        alloc_gpu.setdefault(item["metric"]["instance"], set()).add(item["metric"]["gpuid"])
+    return alloc_gpu
+
+
+def plan_gpu_queries(alloc_gpu, step):
+    """
+    Merges the GPU rollups of a job, on every node, into one PromQL query
+
+    Parameters
+    ----------
+    alloc_gpu : dictionnary
+        node -> IDs of the GPUs of the job on the node, as returned by gpus_of
+    step : integer
+        length of the job in seconds
+
+    Returns
+    -------
+    list
+        the PromQL query, none if the job used no GPU
+    """
+    queries = []
+    for instance in sorted(alloc_gpu.keys()):
+        selector = 'gpu=~"' + "|".join(sorted(alloc_gpu[instance])) + '",instance="' + instance + '"'
+        queries.extend(plan_queries(selector, step, rollups=GPU_ROLLUPS))
+    if not queries:
+        return []
+    return [" or ".join(queries)]
+
+
+def plan_batch_queries(jobids, window, metrics=(), rollups=()):
+    """
+    Merges the queries of many finished jobs into one, their series being selected with slurm_job=~"id1|id2|...". The
+    series of a job only have samples while it runs, so the rollups over a window covering every job give the same
+    values as over the length of each job. The metrics read as they are become last_over_time rollups over that window.
+
+    Parameters
+    ----------
+    jobids : list
+        Slurm jobs' IDs
+    window : integer
+        seconds from the start of the first job to the end of the last one, which is the evaluation time
+    metrics : list
+        names of the metrics read as they are
+    rollups : list
+        (modifier, metric) of the rollups over the length of the jobs
+
+    Returns
+    -------
+    list
+        PromQL queries, to be given to query_all and their results to demultiplex_jobs
+    """
+    selector = 'slurm_job=~"' + "|".join(str(jobid) for jobid in jobids) + '"'
+    return plan_queries(selector, window, rollups=[("last", metric) for metric in metrics] + list(rollups))
+
+
+def demultiplex_jobs(results):
+    """
+    Splits the results of the queries of plan_batch_queries by job, then by metric
+
+    Parameters
+    ----------
+    results : list
+        results of the queries, as returned by query_all
+
+    Returns
+    -------
+    dictionnary
+        job ID (string) -> results of the job, as returned by demultiplex
+    """
+    split = collections.defaultdict(lambda: collections.defaultdict(list))
+    for result in results:
+        for item in result:
+            name = item["metric"]["rollup"]
+            if name.startswith("last_"):
+                # Metric read as it is
+                name = name[len("last_"):]
+            split[item["metric"]["slurm_job"]][name].append(item)
+    return split
+
+
+def summarize_jobs(metadata):
+    """
+    Computes the summaries of many finished jobs: the results of the queries of every Prometheus facet, GPU rollups
+    included. The facets of up to QUERY_BATCH_JOBS jobs are loaded by one query, then the GPU rollups by one query per
+    job which used GPUs, all the queries running concurrently.
+
+    Parameters
+    ----------
+    metadata : dictionnary
+        job ID -> accounting metadata of the job, as returned by Accounting.get_jobs
+
+    Returns
+    -------
+    dictionnary
+        job ID -> summary of the job (metric or rollup name -> series of the job, as returned by demultiplex)
+    """
+    metrics = []
+    rollups = []
+    for facet_metrics, facet_rollups in PROMETHEUS_FACETS.values():
+        metrics.extend(facet_metrics)
+        rollups.extend(facet_rollups)
+
+    # Jobs close in time are batched together, for shorter windows
+    jobids = sorted(metadata, key=lambda jobid: metadata[jobid]["end"])
+    batches = [jobids[i:i + QUERY_BATCH_JOBS] for i in range(0, len(jobids), QUERY_BATCH_JOBS)]
+    futures = []
+    for batch in batches:
+        end = max(metadata[jobid]["end"] for jobid in batch)
+        window = end - min(metadata[jobid]["start"] for jobid in batch)
+        for query_string in plan_batch_queries(batch, max(window, 1), metrics, rollups):
+            futures.append(QUERY_POOL.submit(PROMETHEUS.query, query_string, end))
+    results = demultiplex_jobs([future.result() for future in futures])
+
+    summaries = {}
+    gpu_futures = {}
+    for jobid in jobids:
+        # Every name of the facets is kept, even without series, so the summary is complete
+        summaries[jobid] = dict(results[str(jobid)])
+        for metric in metrics:
+            summaries[jobid].setdefault(metric, [])
+        for modifier, metric in rollups:
+            summaries[jobid].setdefault(modifier + "_" + metric, [])
+        step = metadata[jobid]["end"] - metadata[jobid]["start"]
+        for query_string in plan_gpu_queries(gpus_of(summaries[jobid]["jobs_gpus_used"]), step):
+            gpu_futures[jobid] = QUERY_POOL.submit(PROMETHEUS.query, query_string, metadata[jobid]["end"])
+    for jobid, future in gpu_futures.items():
+        gpu_results = demultiplex([future.result()])
+        for modifier, metric in GPU_ROLLUPS:
+            summaries[jobid][modifier + "_" + metric] = gpu_results[modifier + "_" + metric]
+    return summaries
+
+
+def load_jobs(metadata):
+    """
+    Loads many finished jobs at once, from their stored summaries, the summaries of the other jobs being computed
+    together (see summarize_jobs)
+
+    Parameters
+    ----------
+    metadata : dictionnary
+        job ID -> accounting metadata of the job, as returned by Accounting.get_jobs
+
+    Returns
+    -------
+    dictionnary
+        job ID -> Job object, every facet loaded, or the exception raised while loading the job so one bad job doesn't
+        fail the others
+    """
+    summaries = SUMMARY_STORE.get_many(metadata)
+    summaries.update(summarize_jobs({jobid: metadata[jobid] for jobid in metadata if jobid not in summaries}))
+
+    jobs = {}
+    for jobid in metadata:
+        try:
+            job = Job(jobid)
+            job.preload(metadata[jobid], summaries[jobid])
+            jobs[jobid] = job
+        except Exception as e:
+            jobs[jobid] = e
+    return jobs
 
 
 class Job:
@@ -61,10 +376,64 @@ class Job:
         self.__max_rss = 0
         self.__count_used_cpus = 0
         self.__gpu_data = {}
-        # Retrieve actual data
-        self.get_sacct_data()
-        self.pull_prometheus()
-        self.get_num_used_cpus(80)
+        # Facets of the data already loaded ("accounting" and the ones of PROMETHEUS_FACETS), each is only loaded the first
+        # time it is needed
+        self.__loaded = set()
+
+    def __load(self, *facets):
+        """
+        Loads the facets of the job which aren't loaded yet. The Prometheus facets are loaded together, their queries
+        being merged.
+
+        Parameters
+        ----------
+        facets : strings
+            "accounting" and/or keys of PROMETHEUS_FACETS
+        """
+        if "accounting" not in self.__loaded:
+            # The Prometheus queries need the start and end of the job
+            self.get_accounting_data()
+            self.__loaded.add("accounting")
+        facets = [facet for facet in facets if facet not in self.__loaded]
+        if not facets:
+            return
+        summary = SUMMARY_STORE.get(self.__jobid)
+        if summary is not None:
+            # Computed when the job ended, no query needed
+            self.__parse(facets, summary)
+            return
+
+        metrics = []
+        rollups = []
+        for facet in facets:
+            metrics.extend(PROMETHEUS_FACETS[facet][0])
+            rollups.extend(PROMETHEUS_FACETS[facet][1])
+        queries = plan_queries('slurm_job="' + str(self.__jobid) + '"', self.__step, metrics, rollups)
+        self.__parse(facets, demultiplex(query_all(queries, self.__end_time)))
+
+    def __parse(self, facets, results):
+        """Fills the Prometheus facets of the job from the results of their queries (or from its summary)"""
+        results = collections.defaultdict(list, results)
+        parsers = {"cpu": self.__parse_cpu, "io": self.__parse_io, "threads": self.__parse_threads,
+                   "gpu": self.__parse_gpu}
+        for facet in facets:
+            parsers[facet](results)
+            self.__loaded.add(facet)
+
+    def preload(self, metadata, results):
+        """
+        Loads the job from data already retrieved for many jobs at once (see load_jobs)
+
+        Parameters
+        ----------
+        metadata : dictionnary
+            accounting metadata of the job, as returned by Accounting.get_job
+        results : dictionnary
+            summary of the job, as returned by summarize_jobs
+        """
+        self.get_accounting_data(metadata)
+        self.__loaded.add("accounting")
+        self.__parse(PROMETHEUS_FACETS, results)
 
     def get_num_used_cpus(self, treshold):
         """
@@ -84,40 +453,26 @@ class Job:
             if usage >= treshold_time_per_core:
                 self.__count_used_cpus += 1
 
-    def get_sacct_data(self):
+    def get_accounting_data(self, metadata=None):
         """
-        Parses the output of sacct for the job and fills the associated object attributes
+        Retrieves the accounting metadata of the job (database or sacct) and fills the associated object attributes
 
+        Parameters
+        ----------
+        metadata : dictionnary
+            metadata of the job already retrieved, as returned by Accounting.get_job
         """
-        out = subprocess.check_output(
-            [SACCT, "--units=M", "-X", "-n", "-p",
-                FORMAT, "-j", str(self.__jobid)]
-        )
-
-        out = out.decode("ascii")
-        out = out.split("\n")
-        out = out[0]
-        out = out.split("|")
-
-        self.__sponsor = out[0]
-        self.__username = out[1]
-
-        self.__start_time = int(
-            subprocess.check_output(["/usr/bin/date", "+%s", "-d", out[2]])
-            .decode()
-            .rstrip()
-        )
-
-        self.__end_time = int(
-            subprocess.check_output(["/usr/bin/date", "+%s", "-d", out[3]])
-            .decode()
-            .rstrip()
-        )
-
-        self.__alloc_cpu = int(out[4])
-        self.__alloc_tres = out[5]
-        self.__nodes = out[6]
-        self.__runtime = out[7]
+        if metadata is None:
+            metadata = ACCOUNTING.get_job(self.__jobid)
+
+        self.__sponsor = metadata["account"]
+        self.__username = metadata["user"]
+        self.__start_time = metadata["start"]
+        self.__end_time = metadata["end"]
+        self.__alloc_cpu = metadata["alloc_cpu"]
+        self.__alloc_tres = metadata["alloc_tres"]
+        self.__nodes = metadata["nodes"]
+        self.__runtime = metadata["elapsed"]
         self.__step = self.__end_time - self.__start_time
         for tres in self.__alloc_tres.split(','):
             if 'billing' in tres:
@@ -133,188 +488,77 @@ class Job:
 
     def pull_prometheus(self):
         """
-        Pull data from Prometheus HTTP API with a hardcoded list of metrics and fills the associated object attributes
+        Pull data from Prometheus HTTP API with a hardcoded list of metrics and fills the associated object attributes.
+        Every facet is loaded: the two merged queries of the job are sent at once, then the one of its GPUs.
         """
+        self.__load(*PROMETHEUS_FACETS)
 
-        QUERY_RANGE_URL = PROM_HOST + "/api/v1/query_range"
-
-        # OS Data
-        metrics = ("jobs_cpu_percent", "jobs_rss", "jobs_opened_files")
-        modifiers = [("avg", "max"), ("max",), ("avg",)]
-        # Request the METRICS array since they all have the same form (sum max and avg) over the length of the job and are series OVER TIME
-        tmp_list = []
-
-        for i in range(len(metrics)):
-            for modifier in modifiers[i]:
-                query_string = (
-                    modifier
-                    + "_over_time("
-                    + metrics[i]
-                    + '{slurm_job="'
-                    + str(self.__jobid)
-                    + '"}['
-                    + str(self.__step)
-                    + "s])"
-                )
-                print(query_string, flush=True)
-                print(self.__end_time, flush=True)
-                params = {"query": query_string, "time": self.__end_time}
-                response = requests.get(API_URL, params=params)
-                json = response.json()["data"]["result"]
-                print(json, flush=True)
-                for item in json:
-                    tmp_list.append(float(item["value"][1]))
-
-        self.__avg_cpu_usage = tmp_list[0]
-        self.__max_cpu_usage = tmp_list[1]
-        self.__max_rss = tmp_list[2]
-        self.__opened_files = int(
-            sum(self.transform_float_to_list(tmp_list[3])))
-
-        # I/O Data
-        params = {
-            "query": 'jobs_uses_scratch{slurm_job="' + str(self.__jobid) + '"}',
-            "time": self.__end_time,
-        }
-        response = requests.get(API_URL, params=params)
-
-        for item in response.json()["data"]["result"]:
-            if item["value"][1] == "1":
-                self.__uses_scratch = True
-                break
-
-        metrics = (
-            "jobs_read_mb",
-            "jobs_write_mb",
-            "jobs_read_count",
-            "jobs_write_count",
-        )
-
-        for metric in metrics:
-            params = {
-                "query": metric + '{slurm_job="' + str(self.__jobid) + '"}',
-                "time": self.__end_time,
-            }
-            response = requests.get(API_URL, params=params)
-            json = response.json()["data"]["result"]
-
-            for item in json:
-                if metric == "jobs_read_mb":
-                    self.__read_mb += float(item["value"][1])
-                elif metric == "jobs_read_count":
-                    self.__read_count += float(item["value"][1])
-                elif metric == "jobs_write_count":
-                    self.__write_count += float(item["value"][1])
-                else:
-                    self.__write_mb += float(item["value"][1])
-
-        # Threads counts (i.e. How many threads did you spawn ?)
-        params = {
-            "query": 'max_over_time(jobs_thread_count{slurm_job="'
-            + str(self.__jobid)
-            + '"}['
-            + str(self.__step)
-            + "s])",
-            "time": self.__end_time,
-        }
-        response = requests.get(API_URL, params=params)
-        json = response.json()["data"]["result"]
-
-        # Iterate through each process and collect their threads
-        # Use a dict because the structure is more suitable than a list
-        for item in json:
-            self.__threads[item["metric"]["proc_name"]] = int(
-                item["value"][1]
-            )
+    def __parse_cpu(self, results):
+        """Fills the CPU and memory usage from the results of the queries of the job"""
+        # One value per node of the job
+        self.__avg_cpu_usage = [float(item["value"][1]) for item in results["avg_jobs_cpu_percent"]]
+        self.__max_cpu_usage = [float(item["value"][1]) for item in results["max_jobs_cpu_percent"]]
+        self.__max_rss = [float(item["value"][1]) for item in results["max_jobs_rss"]]
 
         # CPU Times
-        params = {
-            "query": 'jobs_cpu_time_core{slurm_job="' + str(self.__jobid) + '"}',
-            "time": self.__end_time,
-        }
-
-        response = requests.get(API_URL, params=params)
-        json = response.json()["data"]["result"]
-
-        for item in json:
+        for item in results["jobs_cpu_time_core"]:
             self.__cpu_time_core[
                 item["metric"]["instance"] + "_core_" + item["metric"]["core"]
             ] = float(item["value"][1])
 
-        self.__cpu_time_core = self.__cpu_time_core
-
-        params = {
-            "query": 'jobs_cpu_time_total{slurm_job="' + str(self.__jobid) + '"}',
-            "time": self.__end_time,
-        }
-
-        response = requests.get(API_URL, params=params)
-        for item in response.json()["data"]["result"]:
+        for item in results["jobs_cpu_time_total"]:
             self.__cpu_time_total += float(item["value"][1])
 
-        # GPU
-        params = {
-            "query": 'jobs_gpus_used{slurm_job="' + str(self.__jobid) + '"}',
-            "time": self.__end_time,
-        }
+        self.get_num_used_cpus(80)
 
-        response = requests.get(API_URL, params=params)
-        for metric in response.json()["data"]["result"]:
-            # Create set before adding to it. Specific case where the key hasn't yet been inserted into the dictionnary.
-            if metric["metric"]["instance"] not in self.__alloc_gpu.keys():
-                self.__alloc_gpu[metric["metric"]["instance"]] = set()
+    def __parse_io(self, results):
+        """Fills the I/O data from the results of the queries of the job"""
+        self.__opened_files = int(sum(float(item["value"][1]) for item in results["avg_jobs_opened_files"]))
 
-            self.__alloc_gpu[metric["metric"]["instance"]].update(
-                metric["metric"]["gpuid"])
+        for item in results["jobs_uses_scratch"]:
+            if item["value"][1] == "1":
+                self.__uses_scratch = True
+                break
 
-        metrics = ['utilization_gpu', 'utilization_memory',
-                   'temperature_gpu', 'memory_total', 'memory_free', 'memory_used']
-        modifiers = ['max', 'avg', 'min']
+        for item in results["jobs_read_mb"]:
+            self.__read_mb += float(item["value"][1])
+        for item in results["jobs_write_mb"]:
+            self.__write_mb += float(item["value"][1])
+        for item in results["jobs_read_count"]:
+            self.__read_count += float(item["value"][1])
+        for item in results["jobs_write_count"]:
+            self.__write_count += float(item["value"][1])
+
+    def __parse_threads(self, results):
+        """Fills the threads per process name from the results of the queries of the job"""
+        # Iterate through each process and collect their threads
+        # Use a dict because the structure is more suitable than a list
+        for item in results["max_jobs_thread_count"]:
+            self.__threads[item["metric"]["proc_name"]] = int(
+                item["value"][1]
+            )
 
-        for metric in metrics:
-            for modifier in modifiers:
-                tmp_list = []
-                for instance in self.__alloc_gpu.keys():
-                    for gpu in self.__alloc_gpu[instance]:
-
-                        query_string = (
-                            modifier
-                            + "_over_time("
-                            + metric
-                            + '{gpu="'
-                            + gpu
-                            + '",instance="'
-                            + instance
-                            + '"}[' + str(self.__step)
-                            + 's])'
-                        )
-                        params = {"query": query_string,
-                                  "start": self.__start_time,
-                                  "end": self.__end_time,
-                                  }
-                        # if metric != 'gpu_utilization':
-                        #     response = requests.get(API_URL, params=params)
-                        #     print(params, flush=True)
-                        #     json = response.json()["data"]["result"]
-                        #     print(json, flush=True)
-                        #     for item in json:
-                        #         tmp_list.append(float(item["value"][1]))
-                        # else:
-                        params["step"] = str(self.__step) + 's'
-                        print(params, flush=True)
-                        response = requests.get(
-                            QUERY_RANGE_URL, params=params)
-                        json = response.json()["data"]["result"]
-                        print(json, flush=True)
-                        for item in json:
-                            tmp_list.append(float(item["values"][1][1]))
-
-                        self.__gpu_data[modifier + "_" + metric] = tmp_list
+    def __parse_gpu(self, results):
+        """Fills the GPUs of the job from the results of its queries, then their usage (queried if not summarized)"""
+        # GPU
+        for instance, gpus in gpus_of(results["jobs_gpus_used"]).items():
+            self.__alloc_gpu.setdefault(instance, set()).update(gpus)
+
+        queries = plan_gpu_queries(self.__alloc_gpu, self.__step)
+        if queries:
+            if GPU_ROLLUPS[0][0] + "_" + GPU_ROLLUPS[0][1] not in results:
+                # Rollups over the whole job of the GPUs of each node, all in one query
+                results = demultiplex(query_all(queries, self.__end_time))
+            for modifier, metric in GPU_ROLLUPS:
+                items = sorted(results[modifier + "_" + metric],
+                               key=lambda item: (item["metric"]["instance"], item["metric"]["gpu"]))
+                self.__gpu_data[modifier + "_" + metric] = [float(item["value"][1]) for item in items]
 
     def verify_data(self):
         """
         Verifies if CPU Util, core usage, jobs_rss, threads, I/O are withing CC's acceptable usage boundaries
         """
+        self.__load("cpu", "io", "threads")
         # Declarations
         usage_avg_per_cpu = sum(self.transform_float_to_list(
             self.__avg_cpu_usage)) / self.__alloc_cpu
@@ -470,8 +714,14 @@ class Job:
         """Retrieves the self.__out_string attribute"""
         return self.__out_string
 
+    def get_end_time(self):
+        """Retrieves the self.__end_time attribute (epoch)"""
+        self.__load()
+        return self.__end_time
+
     def fill_out_string(self):
         """Fills the self.__out_string object attribute in order to pipe in to the email"""
+        self.__load()
         self.__out_string = self.__out_string + "----------General Data----------\n"
 
         self.__out_string = self.__out_string + "Sponsor: " + self.__sponsor + "\n"
@@ -505,22 +755,16 @@ class Job:
         forpdf: boolean
             tells the function if the calling function was make_pdf()
         """
-        # Constants
+        # Only the start and end of the job are needed, the plot is a single range query
+        self.__load()
         plt.figure()
-        URL = PROM_HOST + "/api/v1/query_range"
 
         if not os.path.exists(dirname):
             os.mkdir(dirname)
 
-        params = {
-            "query": metric + '{slurm_job="' + str(self.__jobid) + '"}',
-            "start": self.__start_time,
-            "end": self.__end_time,
-            "step": STEP_SIZE,
-        }
-
-        response = requests.get(URL, params=params)
-        json = response.json()["data"]["result"]
+        json = PROMETHEUS.query_range(
+            metric + '{slurm_job="' + str(self.__jobid) + '"}', self.__start_time, self.__end_time, STEP_SIZE
+        )
 
         # Iterates thrrough each result given by the JSON returned by the HTTP API
         for item in json:
@@ -594,8 +838,7 @@ class Job:
         forpdf : boolean
             which tells the function if the calling function was make_pdf()
         """
-        # Constants
-        URL = PROM_HOST + "/api/v1/query"
+        self.__load()
 
         # Variables
         labels = []
@@ -607,12 +850,7 @@ class Job:
             os.mkdir(dirname)
 
         for metric in metrics:
-            params = {
-                "query": metric + '{slurm_job="' + str(self.__jobid) + '"}',
-                "time": self.__end_time,
-            }
-            response = requests.get(URL, params=params)
-            json = response.json()["data"]["result"]
+            json = PROMETHEUS.query(metric + '{slurm_job="' + str(self.__jobid) + '"}', self.__end_time)
             for item in json:
                 # Insures we have core numbers only if we're looking for cpu_time_core
                 if "core" in item["metric"]:
@@ -732,6 +970,7 @@ class Job:
         JSON-like dictionnary
             Contains the source of truth
         """
+        self.__load("accounting", *PROMETHEUS_FACETS)
         data = {}
         data["jobid"] = int(self.__jobid)
         data["sponsor"] = self.__sponsor
@@ -1,14 +1,36 @@
 #!/usr/bin/env python3
 
-from flask import Flask, send_file, redirect, url_for
+from flask import Flask, send_file, redirect, url_for, request
 import os
-from job import Job
+import time
+import threading
+from pwd import getpwnam
+from job import Job, ACCOUNTING, SUMMARY_STORE, load_jobs, summarize_jobs
 from user import User
+from report_cache import ReportCache
+from accounting import JobNotFound, JobNotFinished
 from subprocess import CalledProcessError
 
 CWD = "/var/www/logic_webapp/"
+# Maximum size of the cached reports of finished jobs
+REPORT_CACHE_MAX_BYTES = 256 * 1048576
+# A job is only cached once it ended this many seconds ago, when its last samples surely reached Prometheus
+REPORT_CACHE_MIN_AGE = 300
+# Maximum number of jobs of a request to the batch endpoints
+MAX_BATCH_JOBS = 500
+# Rollup stage: seconds between two polls for the jobs which ended, which are summarized once they are
+# REPORT_CACHE_MIN_AGE seconds old, at most ROLLUP_BATCH_JOBS at a time
+ROLLUP_INTERVAL = 60
+ROLLUP_BATCH_JOBS = 500
+# On the first poll, the jobs which ended in this many seconds are summarized
+ROLLUP_BACKFILL = 7 * 86400
+# The jobs whose end is recorded late in the accounting database are found by polling this many seconds back
+ROLLUP_OVERLAP = 3600
+# Summaries older than this are deleted, the reports of their jobs are computed again if requested
+SUMMARY_MAX_AGE = 180 * 86400
 
 app = Flask(__name__)
+REPORT_CACHE = ReportCache(CWD + "reports.sqlite", REPORT_CACHE_MAX_BYTES)
 
 
 @app.route("/")
@@ -113,12 +135,19 @@ def job_pdf(jobid):
 
 @app.route("/api/v1/jobs/<jobid>/usage")
 def job_truth(jobid):
+    if not jobid.isdigit():
+        return {"error": "Job " + jobid + " does not exist"}, 404
+    retval = REPORT_CACHE.get(jobid)
+    if retval is not None:
+        return retval
     try:
         job = Job(jobid)
         retval = job.expose_json()
-    except IndexError:
+        if time.time() - job.get_end_time() >= REPORT_CACHE_MIN_AGE:
+            REPORT_CACHE.put(jobid, retval)
+    except (IndexError, JobNotFound):
         retval = {"error": "Job " + jobid + " does not exist"}, 404
-    except CalledProcessError:
+    except (CalledProcessError, JobNotFinished):
         retval = {"error": "Job " + jobid + " is not finished"}, 404
     except Exception as e:
         retval = {"error": str(e)}
@@ -126,6 +155,77 @@ def job_truth(jobid):
     return retval
 
 
+def batch_reports(jobids, metadata=None):
+    """
+    Returns the reports of many jobs, the ones which aren't cached being loaded together (see job.load_jobs)
+
+    Parameters
+    ----------
+    jobids : list
+        Slurm jobs' IDs (strings)
+    metadata : dictionnary
+        accounting metadata of the jobs already retrieved, as returned by Accounting.get_jobs
+
+    Returns
+    -------
+    dictionnary
+        job ID -> report of the job, or the error of the job like /api/v1/jobs/<jobid>/usage
+    """
+    reports = {}
+    for jobid in jobids:
+        report = REPORT_CACHE.get(jobid)
+        if report is not None:
+            reports[jobid] = report
+    missing = [jobid for jobid in jobids if jobid not in reports]
+    if missing:
+        if metadata is None:
+            metadata = ACCOUNTING.get_jobs(missing)
+        for jobid in missing:
+            if jobid not in metadata:
+                reports[jobid] = {"error": "Job " + jobid + " does not exist"}
+            elif metadata[jobid] is None:
+                reports[jobid] = {"error": "Job " + jobid + " is not finished"}
+        finished = {jobid: metadata[jobid] for jobid in missing if metadata.get(jobid) is not None}
+        for jobid, job in load_jobs(finished).items():
+            if isinstance(job, Exception):
+                reports[jobid] = {"error": str(job)}
+                continue
+            try:
+                reports[jobid] = job.expose_json()
+            except Exception as e:
+                reports[jobid] = {"error": str(e)}
+                continue
+            if time.time() - job.get_end_time() >= REPORT_CACHE_MIN_AGE:
+                REPORT_CACHE.put(jobid, reports[jobid])
+    return reports
+
+
+@app.route("/api/v1/jobs/usage")
+def jobs_truth():
+    jobids = [jobid for jobid in request.args.get("ids", "").split(",") if jobid]
+    if not all(jobid.isdigit() for jobid in jobids):
+        return {"error": "Job IDs must be integers separated by commas"}, 400
+    if len(jobids) > MAX_BATCH_JOBS:
+        return {"error": "At most " + str(MAX_BATCH_JOBS) + " jobs can be requested at once"}, 400
+    try:
+        retval = {"jobs": batch_reports(jobids)}
+    except Exception as e:
+        retval = {"error": str(e)}
+    return retval
+
+
+@app.route("/api/v1/users/<username>/jobs/usage")
+def user_jobs_truth(username):
+    try:
+        metadata = ACCOUNTING.get_user_jobs(getpwnam(username).pw_uid, MAX_BATCH_JOBS)
+        retval = {"jobs": batch_reports(sorted(metadata, key=int), metadata)}
+    except KeyError:
+        retval = {"error": "User " + username + " does not exist"}, 404
+    except Exception as e:
+        retval = {"error": str(e)}
+    return retval
+
+
 @app.route("/api/v1/users/<username>")
 def user_truth(username):
     try:
@@ -138,5 +238,43 @@ def user_truth(username):
     return retval
 
 
+def rollup_finished_jobs():
+    """
+    Computes and stores the summaries of the jobs which ended since the last poll
+
+    Returns
+    -------
+    integer
+        number of jobs summarized
+    """
+    now = int(time.time())
+    until = now - REPORT_CACHE_MIN_AGE
+    after = (max(SUMMARY_STORE.last_end_time() - ROLLUP_OVERLAP, now - ROLLUP_BACKFILL), 0)
+    count = 0
+    while after is not None:
+        jobs, after = ACCOUNTING.get_finished_jobs(after, until, ROLLUP_BATCH_JOBS)
+        # Jobs cancelled before they started have no metadata, nor data to summarize
+        metadata = {jobid: job for jobid, job in jobs.items() if job is not None}
+        missing = SUMMARY_STORE.missing(metadata)
+        for jobid, summary in summarize_jobs({jobid: metadata[jobid] for jobid in missing}).items():
+            SUMMARY_STORE.put(jobid, metadata[jobid]["end"], summary)
+        count += len(missing)
+    SUMMARY_STORE.prune(now - SUMMARY_MAX_AGE)
+    return count
+
+
+def rollup_loop():
+    """Rollup stage: summarizes the jobs as they end, so their reports cost the same whatever their length"""
+    while True:
+        try:
+            count = rollup_finished_jobs()
+            if count:
+                print("[+] Summarized " + str(count) + " finished jobs [+]", flush=True)
+        except Exception as e:
+            print("[-] Could not summarize the finished jobs: " + str(e) + " [-]", flush=True)
+        time.sleep(ROLLUP_INTERVAL)
+
+
 if __name__ == "__main__":
+    threading.Thread(target=rollup_loop, daemon=True).start()
     app.run()
@@ -0,0 +1,87 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class ReportCache:
+    """
+    On-disk cache of the reports (expose_json) of finished jobs, whose data never changes. The reports are kept in a
+    SQLite database bounded in size, the least recently used ones being evicted first.
+    """
+
+    def __init__(self, path, max_bytes):
+        """
+        Parameters
+        ----------
+        path : string
+            path of the SQLite database, created if it doesn't exist
+        max_bytes : integer
+            maximum total size of the reports kept
+        """
+        self.__max_bytes = max_bytes
+        # Flask serves the requests from several threads, they share the connection one at a time
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        # With WAL and synchronous=NORMAL, recording an access doesn't wait for the disk
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS reports ("
+            "jobid INTEGER PRIMARY KEY, report TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS reports_last_access ON reports (last_access)")
+        self.__connection.commit()
+
+    def get(self, jobid):
+        """
+        Returns the cached report of a job
+
+        Parameters
+        ----------
+        jobid : integer
+            Slurm job's ID
+
+        Returns
+        -------
+        dictionnary or None
+            the report, None if it isn't cached
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT report FROM reports WHERE jobid = ?", (int(jobid),)).fetchone()
+            if row is None:
+                return None
+            self.__connection.execute("UPDATE reports SET last_access = ? WHERE jobid = ?", (time.time(), int(jobid)))
+            self.__connection.commit()
+        return json.loads(row[0])
+
+    def put(self, jobid, report):
+        """
+        Caches the report of a job, evicting the least recently used reports past the maximum size
+
+        Parameters
+        ----------
+        jobid : integer
+            Slurm job's ID
+        report : dictionnary
+            report of the job, as returned by Job.expose_json
+        """
+        report = json.dumps(report)
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO reports (jobid, report, size, last_access) VALUES (?, ?, ?, ?)",
+                (int(jobid), report, len(report), time.time()),
+            )
+            total = self.__connection.execute("SELECT COALESCE(SUM(size), 0) FROM reports").fetchone()[0]
+            if total > self.__max_bytes:
+                # Oldest accesses first, until the reports left fit
+                evicted = []
+                for evicted_jobid, size in self.__connection.execute(
+                    "SELECT jobid, size FROM reports ORDER BY last_access"
+                ):
+                    if total <= self.__max_bytes:
+                        break
+                    evicted.append((evicted_jobid,))
+                    total -= size
+                self.__connection.executemany("DELETE FROM reports WHERE jobid = ?", evicted)
+            self.__connection.commit()
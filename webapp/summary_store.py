@@ -0,0 +1,135 @@
+import json
+import sqlite3
+import threading
+
+# Under SQLite's limit of 999 parameters per statement
+MAX_PARAMETERS = 500
+
+
+class SummaryStore:
+    """
+    On-disk store of the summaries of finished jobs: the results of the Prometheus queries of every facet of a job,
+    computed once when the job ends. Loading a job from its summary costs no Prometheus query, whatever its length.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : string
+            path of the SQLite database, created if it doesn't exist
+        """
+        # Flask and the rollup stage share the connection one at a time
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "jobid INTEGER PRIMARY KEY, summary TEXT NOT NULL, end_time INTEGER NOT NULL)"
+        )
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS summaries_end_time ON summaries (end_time)")
+        self.__connection.commit()
+
+    def get(self, jobid):
+        """
+        Returns the summary of a job
+
+        Parameters
+        ----------
+        jobid : integer
+            Slurm job's ID
+
+        Returns
+        -------
+        dictionnary or None
+            metric (or rollup) name -> series of the job, None if the job has no summary
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT summary FROM summaries WHERE jobid = ?", (int(jobid),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_many(self, jobids):
+        """
+        Returns the summaries of many jobs
+
+        Parameters
+        ----------
+        jobids : list
+            Slurm jobs' IDs
+
+        Returns
+        -------
+        dictionnary
+            job ID (string) -> summary of the job, the jobs with no summary being left out
+        """
+        return {str(jobid): json.loads(summary) for jobid, summary in self.__select("jobid, summary", jobids)}
+
+    def missing(self, jobids):
+        """
+        Returns the jobs which have no summary
+
+        Parameters
+        ----------
+        jobids : list
+            Slurm jobs' IDs
+
+        Returns
+        -------
+        list
+            IDs of the jobs (strings) with no summary
+        """
+        stored = set(str(row[0]) for row in self.__select("jobid", jobids))
+        return [str(jobid) for jobid in jobids if str(jobid) not in stored]
+
+    def __select(self, columns, jobids):
+        """Returns the rows of the jobs which have a summary"""
+        jobids = [int(jobid) for jobid in jobids]
+        rows = []
+        with self.__lock:
+            for i in range(0, len(jobids), MAX_PARAMETERS):
+                chunk = jobids[i:i + MAX_PARAMETERS]
+                rows.extend(self.__connection.execute(
+                    "SELECT " + columns + " FROM summaries WHERE jobid IN (" + ", ".join(["?"] * len(chunk)) + ")", chunk
+                ))
+        return rows
+
+    def put(self, jobid, end_time, summary):
+        """
+        Stores the summary of a job
+
+        Parameters
+        ----------
+        jobid : integer
+            Slurm job's ID
+        end_time : integer
+            end of the job (epoch)
+        summary : dictionnary
+            metric (or rollup) name -> series of the job
+        """
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO summaries (jobid, summary, end_time) VALUES (?, ?, ?)",
+                (int(jobid), json.dumps(summary), int(end_time)),
+            )
+            self.__connection.commit()
+
+    def last_end_time(self):
+        """Returns the end (epoch) of the last job with a summary, 0 if there is none"""
+        with self.__lock:
+            return self.__connection.execute("SELECT COALESCE(MAX(end_time), 0) FROM summaries").fetchone()[0]
+
+    def prune(self, before):
+        """
+        Deletes the summaries of the jobs which ended before a time, their reports being computed again if requested
+
+        Parameters
+        ----------
+        before : integer
+            epoch
+        """
+        with self.__lock:
+            self.__connection.execute("DELETE FROM summaries WHERE end_time < ?", (int(before),))
+            self.__connection.commit()